@@ -1,14 +1,29 @@
 print("[main.py] Module loading...", flush=True)
 
 from fastapi import FastAPI, Request, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import os
+import json
 import time
-import sqlalchemy
-from sqlalchemy import text
+import asyncio
+import anyio
+import math
+import base64
+import hashlib
+import re
+from typing import List, Optional
+from urllib.parse import quote
+from pydantic import BaseModel, Field
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from utils.stop_index import StopIndex, DEFAULT_CELL_SIZE, DEFAULT_COLUMNS
+from utils.clusters import MAX_ZOOM as CLUSTER_MAX_ZOOM, cell_range
+from utils import search, sqlite_files, stops_binary
+from utils.mvt import DEFAULT_EXTENT, encode_point_layer, project, tile_bounds
 
 print("[main.py] Imports done", flush=True)
 
@@ -19,22 +34,703 @@ print("[main.py] FastAPI app created", flush=True)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./stops.db")
 engine = None
 
+# The API reads through SQLAlchemy's asyncio engine: asyncpg for Postgres
+# (prepared statements are cached per connection by the dialect) and aiosqlite
+# for SQLite, with a pool of DB_POOL_SIZE (+ DB_MAX_OVERFLOW) connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# SQLite: the database file the engine reads. utils/merge.py publishes each
+# full load as a new file (utils/sqlite_files.py); the generation poll
+# notices and moves the engine over without a restart.
+sqlite_file = None
+
+
+def async_database_url(url: str) -> str:
+    """Point a plain sqlite:// or postgres:// URL at its asyncio driver."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    return url
+
+# SQLite serving profile, applied to every pooled connection when
+# SQLITE_PROFILE=serving: WAL so readers don't block on the merge writer,
+# a large mmap and page cache, query_only so the API can never write.
+# SQLITE_PROFILE=off leaves SQLite's defaults untouched.
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "serving").lower()
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "wal"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(1024 * 1024 * 1024))),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),  # negative = KiB
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "memory"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "query_only": 1,
+}
+
+
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    """Connect hook: set SQLITE_PRAGMAS on a new pooled SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in SQLITE_PRAGMAS.items():
+            try:
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+            except Exception as e:
+                # e.g. WAL on a read-only directory; keep serving with the default
+                print(f"⚠️ PRAGMA {pragma} = {value} failed: {e}", flush=True)
+    finally:
+        cursor.close()
+
+
+async def sqlite_self_check(conn):
+    """Print the pragmas SQLite actually uses, warning where they differ from the profile."""
+    effective = {}
+    for pragma in SQLITE_PRAGMAS:
+        effective[pragma] = (await conn.execute(text(f"PRAGMA {pragma}"))).scalar()
+    print(f"[main.py] SQLite settings: {effective}", flush=True)
+    if SQLITE_PROFILE == "serving":
+        journal_mode = str(effective["journal_mode"]).lower()
+        if journal_mode != SQLITE_PRAGMAS["journal_mode"].lower():
+            print(f"⚠️ SQLite journal_mode is {journal_mode}, readers may block while merge.py writes", flush=True)
+        if not effective["mmap_size"] and SQLITE_PRAGMAS["mmap_size"]:
+            print("⚠️ SQLite mmap is disabled in this build", flush=True)
+
+# Serving engine for /api/stops: "sql" queries the database on every request,
+# "memory" loads all stops into an in-process spatial index at startup.
+STOPS_ENGINE = os.getenv("STOPS_ENGINE", "sql").lower()
+STOPS_INDEX_CELL_SIZE = float(os.getenv("STOPS_INDEX_CELL_SIZE", str(DEFAULT_CELL_SIZE)))
+# Snapshot of the memory index written by utils/merge.py. When it matches the
+# data generation, each worker maps it instead of loading every stop from the
+# database, so N uvicorn workers share one copy of the index.
+STOPS_SNAPSHOT = os.getenv("STOPS_SNAPSHOT", "")
+stop_index = None
+
+# Nearest-stop search: the search box starts NEAREST_START_M around the point
+# and doubles until k stops are found or radius_m is reached.
+NEAREST_START_M = float(os.getenv("NEAREST_START_M", "200"))
+NEAREST_MAX_RADIUS_M = float(os.getenv("NEAREST_MAX_RADIUS_M", "50000"))
+NEAREST_MAX_K = int(os.getenv("NEAREST_MAX_K", "100"))
+NEAREST_MAX_CANDIDATES = int(os.getenv("NEAREST_MAX_CANDIDATES", "50000"))
+EARTH_RADIUS_M = 6371008.8
+
+# Batch bbox queries: at most BATCH_MAX_BBOXES boxes per request, answered by
+# one UNION ALL statement (prepared once per batch size) on one connection.
+BATCH_MAX_BBOXES = int(os.getenv("BATCH_MAX_BBOXES", "64"))
+batch_queries = {}
+
+# Spatial index behind the bbox queries (bbox_index), detected with the schema:
+# "rtree" for the SQLite stops_rtree R*Tree, "postgis" for the Postgres
+# stops.geom GiST index, both built by utils/merge.py; None for the (lon, lat)
+# B-tree. SQLITE_RTREE=off / POSTGIS=off keep the B-tree. "postgis" also needs
+# the merge to have recorded geom_complete in stops_meta.
+SQLITE_RTREE = os.getenv("SQLITE_RTREE", "auto").lower()
+POSTGIS = os.getenv("POSTGIS", "auto").lower()
+BBOX_INDEX_NAMES = {"rtree": "stops_rtree", "postgis": "idx_stops_geom"}
+bbox_index = None
+
+# Result order of /api/stops (?order=): "name" sorts by (name, id), "spatial"
+# by the progressive zkey from utils/spatial_order.py (stored by the merge,
+# spatial_ready once the column exists), "none" returns rows as found.
+BBOX_ORDERS = ("name", "spatial", "none")
+spatial_ready = False
+
+# Field projection (?fields=) and coordinate rounding (?precision=) on the
+# bbox, batch and export endpoints. Only the requested columns are selected
+# (statements are prepared once per field list, in projected_queries) and
+# lon/lat are rounded to `precision` decimals before encoding; 5 is ~1 m.
+STOP_FIELDS = ("name", "bearing", "lon", "lat", "source")
+EXPORT_FIELDS = ("id", "name", "bearing", "lon", "lat", "source", "created_at")
+MAX_PRECISION = 7
+projected_queries = {}
+
+# Name search (/api/stops/search) reads the stops_search index built by
+# utils/merge.py; search_ready is detected together with the schema.
+SEARCH_DEFAULT_LIMIT = int(os.getenv("SEARCH_DEFAULT_LIMIT", "20"))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+# Up to this many names starting with q are fetched (in index order) and
+# ranked; sorting every match of a one-letter query costs up to a second.
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "200"))
+search_ready = False
+
+# /api/clusters reads the stop_clusters pyramid written by utils/merge.py;
+# clusters_ready is detected together with the schema.
+clusters_ready = False
+
+# NDJSON export is fetched from a server-side cursor and sent in chunks of
+# EXPORT_CHUNK_ROWS rows, so memory use is independent of the table size.
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+# Data generation: bumped by utils/merge.py in stops_meta after every load.
+# The API re-reads it at most every GENERATION_POLL_SECONDS and derives ETags
+# from it, so repeat requests are answered with 304 until the data changes.
+GENERATION_POLL_SECONDS = float(os.getenv("GENERATION_POLL_SECONDS", "5"))
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", "60"))
+CACHEABLE_PATHS = ("/api/stops", "/api/allstops", "/api/clusters", "/api/tiles/", "/api/export.ndjson", "/data")
+data_generation = None
+generation_checked_at = 0.0
+generation_lock = asyncio.Lock()
+reload_task = None
+
+# Vector tiles: below MVT_MIN_ZOOM tiles are empty, below MVT_FULL_ZOOM stops
+# are thinned to one per grid cell, MVT_TILE_LIMIT caps the rows per tile.
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+MVT_MIN_ZOOM = int(os.getenv("MVT_MIN_ZOOM", "6"))
+MVT_FULL_ZOOM = int(os.getenv("MVT_FULL_ZOOM", "15"))
+MVT_TILE_LIMIT = int(os.getenv("MVT_TILE_LIMIT", "20000"))
+MVT_CACHE_SECONDS = int(os.getenv("MVT_CACHE_SECONDS", "3600"))
+MVT_BUFFER = 64  # tile units kept outside the tile edge so symbols aren't clipped
+
+# Query budgets, so that one huge request can't starve everyone else:
+# - QUERY_MAX_LIMIT caps ?limit of the bbox, batch, cluster and list endpoints.
+# - A bbox may cover at most BBOX_MAX_AREA square degrees, and, when the
+#   client sends its map zoom, at most BBOX_VIEWPORT_TILES tiles of that zoom.
+# - Every buffered query is cancelled after QUERY_TIMEOUT_MS (0 = off): by
+#   Postgres' statement_timeout, set on each asyncpg connection, or by
+#   interrupting SQLite. Streamed queries (export, index load) are exempt.
+# - At most QUERY_MAX_CONCURRENCY /api requests run at once; the rest wait up
+#   to QUEUE_TIMEOUT_MS for a slot and are then shed with 503 + Retry-After.
+# budget_hits counts every budget that was hit, served at /api/budgets.
+QUERY_MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", "20000"))
+BBOX_MAX_AREA = float(os.getenv("BBOX_MAX_AREA", "100"))
+BBOX_VIEWPORT_TILES = int(os.getenv("BBOX_VIEWPORT_TILES", "64"))
+QUERY_TIMEOUT_MS = int(os.getenv("QUERY_TIMEOUT_MS", "5000"))
+QUERY_MAX_CONCURRENCY = int(os.getenv("QUERY_MAX_CONCURRENCY", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+QUEUE_TIMEOUT_MS = int(os.getenv("QUEUE_TIMEOUT_MS", "1000"))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "1"))
+query_slots = asyncio.Semaphore(QUERY_MAX_CONCURRENCY)
+queries_in_flight = 0
+budget_hits = {"limit": 0, "area": 0, "timeout": 0, "shed": 0}
+
+
+def clamp_limit(limit: int) -> int:
+    """limit, cut down to QUERY_MAX_LIMIT. Endpoints reject negative limits (ge=0)."""
+    if limit > QUERY_MAX_LIMIT:
+        budget_hits["limit"] += 1
+        return QUERY_MAX_LIMIT
+    return limit
+
+
+def area_budget(zoom: int = None) -> float:
+    """Largest bbox area, in square degrees, a query may cover at this zoom."""
+    if zoom is None:
+        return BBOX_MAX_AREA
+    tile = 360.0 / 2 ** max(zoom, 0)
+    return min(BBOX_MAX_AREA, BBOX_VIEWPORT_TILES * tile * tile)
+
+
+def check_area(xmin, xmax, ymin, ymax, zoom: int = None):
+    """Error response for a bbox over its area budget, or None."""
+    budget = area_budget(zoom)
+    if (xmax - xmin) * (ymax - ymin) <= budget:
+        return None
+    budget_hits["area"] += 1
+    return JSONResponse(
+        {"error": f"bbox larger than {budget:g} square degrees, zoom in or use /api/clusters"},
+        status_code=400,
+    )
+
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """before_cursor_execute hook: interrupt the SQLite statement after QUERY_TIMEOUT_MS."""
+    if context is not None and context.execution_options.get("stream_results"):
+        return
+    driver = conn.connection.driver_connection
+    timer = {}
+
+    async def interrupt():
+        # Only if this statement is still the one running
+        if conn.info.get("query_timer") is timer:
+            await driver.interrupt()
+
+    timer["handle"] = asyncio.get_running_loop().call_later(
+        QUERY_TIMEOUT_MS / 1000, lambda: asyncio.ensure_future(interrupt())
+    )
+    conn.info["query_timer"] = timer
+
+
+def stop_query_timer(conn, *args):
+    """after_cursor_execute hook: the statement finished in time."""
+    timer = conn.info.pop("query_timer", None)
+    if timer:
+        timer["handle"].cancel()
+
+
+def stop_query_timer_on_error(exception_context):
+    """handle_error hook: the statement failed (or was interrupted)."""
+    if exception_context.connection is not None:
+        stop_query_timer(exception_context.connection)
+
+
+def is_query_timeout(e: Exception) -> bool:
+    """True for a statement cancelled by QUERY_TIMEOUT_MS."""
+    orig = getattr(e, "orig", None)
+    # 57014 = query_canceled (statement_timeout); SQLite reports "interrupted"
+    return getattr(orig, "sqlstate", None) == "57014" or "interrupted" in str(orig or "")
+
+
+def query_error(e: Exception) -> JSONResponse:
+    """Response for a failed query: 503 + Retry-After if it ran out of time, else 500."""
+    if is_query_timeout(e):
+        budget_hits["timeout"] += 1
+        print(f"⚠️ Query cancelled after {QUERY_TIMEOUT_MS}ms", flush=True)
+        return JSONResponse(
+            {"error": "Query took too long, try a smaller bbox"},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    print(f"⚠️ Query failed: {e}", flush=True)
+    return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def render_json(content, headers=None) -> JSONResponse:
+    """
+    A JSONResponse encoded in the threadpool. Handlers are async, so
+    anything CPU-heavy (index lookups, ranking, encoding thousands of rows)
+    is handed to run_in_threadpool instead of holding up the event loop.
+    """
+    return await run_in_threadpool(JSONResponse, content, headers=headers)
+
+
+# Column layout of the stops table and the SQL prepared for it. Both are
+# detected once at startup and only refreshed (refresh_schema) when a new data
+# generation is loaded, instead of probing the schema on every request.
+STOPS_LAYOUTS = {
+    "lonlat": {"lon": "lon", "lat": "lat"},
+    "location": {"lon": "location[1]", "lat": "location[2]"},
+}
+stops_layout = None
+queries = {}
+
+
+async def stops_columns(conn):
+    """Column names of the stops table."""
+    if conn.dialect.name == "sqlite":
+        return [row[1] for row in await conn.execute(text("PRAGMA table_info('stops');"))]
+    return [row[0] for row in await conn.execute(text("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name='stops';
+        """))]
+
+
+def detect_stops_layout(cols):
+    """Return "lonlat" or "location" depending on the stops table columns."""
+    if "lon" in cols and "lat" in cols:
+        return "lonlat"
+    if "location" in cols:
+        return "location"
+    return None
+
+
+async def table_exists(conn, name: str) -> bool:
+    """Whether the database has a table `name`."""
+    if conn.dialect.name == "sqlite":
+        found = await conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": name})
+    else:
+        found = await conn.execute(text("SELECT 1 FROM information_schema.tables WHERE table_name = :name"), {"name": name})
+    return found.first() is not None
+
+
+async def detect_search_index(conn):
+    """Whether utils/merge.py has built the stops_search name index."""
+    return await table_exists(conn, "stops_search")
+
+
+async def detect_bbox_index(conn, layout: str):
+    """Which spatial index the bbox queries can use: "rtree", "postgis" or None."""
+    if layout != "lonlat":
+        return None
+    if conn.dialect.name == "sqlite":
+        if SQLITE_RTREE == "off":
+            return None
+        found = await conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'stops_rtree'"))
+        return "rtree" if found.first() is not None else None
+    if POSTGIS == "off" or not await table_exists(conn, "stops_meta"):
+        return None
+    # The merge sets geom_complete once every located stop has geom filled;
+    # a geom column left over from an earlier PostGIS run is not enough
+    found = await conn.execute(text("SELECT value FROM stops_meta WHERE key = 'geom_complete'"))
+    return "postgis" if found.scalar() == "1" else None
+
+
+async def explain_bbox(conn):
+    """Log the plan of the bbox query, warning if it doesn't use bbox_index."""
+    params = {"xmin": 0, "xmax": 1, "ymin": 0, "ymax": 1, "limit": 1, "offset": 0}
+    if conn.dialect.name == "sqlite":
+        plan = [row[3] for row in await conn.execute(text(f"EXPLAIN QUERY PLAN {queries['bbox'].text}"), params)]
+    else:
+        plan = [row[0] for row in await conn.execute(text(f"EXPLAIN {queries['bbox'].text}"), params)]
+    print(f"[main.py] bbox query plan: {plan}", flush=True)
+    if not any(BBOX_INDEX_NAMES[bbox_index] in step for step in plan):
+        print(f"⚠️ bbox queries are not using {BBOX_INDEX_NAMES[bbox_index]}", flush=True)
+
+
+def bbox_filter(lon: str, lat: str, index: str = None, suffix: str = "") -> str:
+    """
+    FROM and WHERE of a bbox query for the given spatial index. With the
+    R*Tree, SQLite is made to start from it (CROSS JOIN fixes the join order).
+    The exact coordinate test always follows, as both the R*Tree and the GiST
+    index store rounded 32-bit float boxes.
+    """
+    where = f"{lon} BETWEEN :xmin{suffix} AND :xmax{suffix} AND {lat} BETWEEN :ymin{suffix} AND :ymax{suffix}"
+    if index == "rtree":
+        return f"""stops_rtree CROSS JOIN stops ON stops.id = stops_rtree.id
+            WHERE stops_rtree.min_lon <= :xmax{suffix} AND stops_rtree.max_lon >= :xmin{suffix}
+            AND stops_rtree.min_lat <= :ymax{suffix} AND stops_rtree.max_lat >= :ymin{suffix}
+            AND {where}"""
+    if index == "postgis":
+        return f"""stops
+            WHERE geom && ST_MakeEnvelope(:xmin{suffix}, :ymin{suffix}, :xmax{suffix}, :ymax{suffix}, 4326)
+            AND {where}"""
+    return f"stops WHERE {where}"
+
+
+def prepare_queries(layout: str, dialect: str, index: str = None, spatial: bool = False):
+    """Build every statement the endpoints need for the given column layout."""
+    lon = STOPS_LAYOUTS[layout]["lon"]
+    lat = STOPS_LAYOUTS[layout]["lat"]
+    columns = f"name, bearing, {lon} AS lon, {lat} AS lat"
+
+    if dialect == "sqlite":
+        # SQLite sorts NULL names first
+        after_null = "(name IS NULL AND id > :after_id) OR name IS NOT NULL"
+        search_from = "stops_search JOIN stops ON stops.id = stops_search.rowid WHERE stops_search MATCH"
+        search_starts = f"{search_from} :starts"
+        search_rest = f"""{search_from} :match
+            AND stops_search.rowid NOT IN (SELECT rowid FROM stops_search WHERE stops_search MATCH :starts)"""
+        search_with = ""
+    else:
+        # Postgres sorts NULL names last
+        after_null = "name IS NULL AND id > :after_id"
+        # LIKE 'q%' reads the text_pattern_ops index
+        search_starts = "stops_search JOIN stops ON stops.id = stops_search.id WHERE name_folded LIKE :starts"
+        # Materialized, so the GIN index is always used: with the LIMIT in
+        # view the planner would scan the table, all of it if nothing matches
+        search_with = """WITH matches AS MATERIALIZED (
+                SELECT id FROM stops_search
+                WHERE to_tsvector('simple', name_folded) @@ to_tsquery('simple', :match)
+                AND name_folded NOT LIKE :starts
+            )"""
+        search_rest = "matches JOIN stops ON stops.id = matches.id"
+
+    def all_stops(where: str = ""):
+        return text(f"""
+            SELECT id, {columns}
+            FROM stops
+            {where}
+            ORDER BY name, id
+            LIMIT :limit OFFSET :offset
+        """)
+
+    return {
+        "bbox": prepare_bbox_query(layout, index, DEFAULT_COLUMNS),
+        "bbox_unordered": text(f"""
+            SELECT {columns}
+            FROM {bbox_filter(lon, lat, index)}
+            LIMIT :limit
+        """),
+        "all": all_stops(),
+        "all_after": all_stops("WHERE (name, id) > (:after_name, :after_id)"),
+        "all_after_null": all_stops(f"WHERE {after_null}"),
+        "clusters": text("""
+            SELECT lon, lat, count, source
+            FROM stop_clusters
+            WHERE zoom = :zoom
+            AND cx BETWEEN :cx0 AND :cx1
+            AND cy BETWEEN :cy0 AND :cy1
+            LIMIT :limit
+        """),
+        # Unordered on purpose: search.rank() orders what these return
+        "search_starts": text(f"""
+            SELECT stops.name, stops.bearing, {lon} AS lon, {lat} AS lat, stops.source
+            FROM {search_starts}
+            LIMIT :limit
+        """),
+        "search_rest": text(f"""
+            {search_with}
+            SELECT stops.name, stops.bearing, {lon} AS lon, {lat} AS lat, stops.source
+            FROM {search_rest}
+            LIMIT :limit
+        """),
+        "index_load": text(f"SELECT {columns}, source, {'zkey' if spatial else 'NULL AS zkey'} FROM stops ORDER BY name, id"),
+    }
+
+
+def select_list(layout: str, fields) -> str:
+    """SELECT expressions for the given stop fields, named after them."""
+    lon = STOPS_LAYOUTS[layout]["lon"]
+    lat = STOPS_LAYOUTS[layout]["lat"]
+    expressions = {"id": "stops.id AS id", "lon": f"{lon} AS lon", "lat": f"{lat} AS lat"}
+    return ", ".join(expressions.get(field, field) for field in fields)
+
+
+def prepare_bbox_query(layout: str, index: str, fields, order: str = "name"):
+    """The /api/stops statement selecting `fields`, in one of BBOX_ORDERS."""
+    lon = STOPS_LAYOUTS[layout]["lon"]
+    lat = STOPS_LAYOUTS[layout]["lat"]
+    columns = select_list(layout, fields)
+    if order == "spatial":
+        # The page is picked from the (lon, lat, zkey, name) covering index
+        # alone, and only its rows are read from the table. zkey ties (stops
+        # at the same spot) fall back to (name, id), as in StopIndex.
+        return text(f"""
+            SELECT {columns}
+            FROM stops
+            WHERE stops.id IN (
+                SELECT stops.id
+                FROM {bbox_filter(lon, lat)}
+                ORDER BY zkey, name, stops.id
+                LIMIT :limit OFFSET :offset
+            )
+            ORDER BY zkey, name, stops.id
+        """)
+    return text(f"""
+        SELECT {columns}
+        FROM {bbox_filter(lon, lat, index)}
+        {"ORDER BY name, stops.id" if order == "name" else ""}
+        LIMIT :limit OFFSET :offset
+    """)
+
+
+def prepare_export_query(layout: str, fields, by_source: bool):
+    """The NDJSON export statement selecting `fields`, optionally for one source."""
+    return text(f"""
+        SELECT {select_list(layout, fields)}
+        FROM stops
+        {"WHERE source = :source" if by_source else ""}
+        ORDER BY id
+    """)
+
+
+def projected_query(kind: str, fields, *args):
+    """A bbox ("bbox", order) or export ("export", by_source) statement for `fields`, prepared once."""
+    key = (kind, fields) + args
+    statement = projected_queries.get(key)
+    if statement is None:
+        if kind == "bbox":
+            statement = prepare_bbox_query(stops_layout, bbox_index, fields, *args)
+        else:
+            statement = prepare_export_query(stops_layout, fields, *args)
+        projected_queries[key] = statement
+    return statement
+
+
+def parse_fields(fields, allowed, default):
+    """Requested fields (comma-separated or a list) as a tuple; ValueError if any is unknown."""
+    if not fields:
+        return default
+    names = fields.split(",") if isinstance(fields, str) else fields
+    chosen = tuple(dict.fromkeys(name.strip() for name in names if name.strip()))
+    if not chosen or any(name not in allowed for name in chosen):
+        raise ValueError(f"fields must be a comma-separated subset of {', '.join(allowed)}")
+    return chosen
+
+
+def round_coordinates(stops, precision):
+    """Round lon/lat of result dicts to `precision` decimals, in place."""
+    if precision is None:
+        return stops
+    for stop in stops:
+        for key in ("lon", "lat"):
+            if stop.get(key) is not None:
+                stop[key] = round(stop[key], precision)
+    return stops
+
+
+def prepare_batch_query(layout: str, size: int, index: str = None, fields=DEFAULT_COLUMNS):
+    """One statement answering `size` bboxes, each ordered by (name, id) with its own limit."""
+    lon = STOPS_LAYOUTS[layout]["lon"]
+    lat = STOPS_LAYOUTS[layout]["lat"]
+    columns = select_list(layout, fields)
+    # sort_name keeps the (name, id) order when name isn't one of the fields
+    parts = [f"""
+        SELECT * FROM (
+            SELECT {i} AS q, stops.id AS id, name AS sort_name, {columns}
+            FROM {bbox_filter(lon, lat, index, f"_{i}")}
+            ORDER BY name, stops.id
+            LIMIT :limit_{i}
+        ) AS b{i}""" for i in range(size)]
+    return text(" UNION ALL ".join(parts) + " ORDER BY q, sort_name, id")
+
+
+async def refresh_schema():
+    """Detect the stops table layout and prepare its queries."""
+    global stops_layout, queries, search_ready, clusters_ready, bbox_index, spatial_ready
+    async with engine.connect() as conn:
+        cols = await stops_columns(conn)
+        stops_layout = detect_stops_layout(cols)
+        spatial_ready = "zkey" in cols
+        search_ready = await detect_search_index(conn)
+        clusters_ready = await table_exists(conn, "stop_clusters")
+        bbox_index = await detect_bbox_index(conn, stops_layout)
+        queries = prepare_queries(stops_layout, engine.dialect.name, bbox_index, spatial_ready) if stops_layout else {}
+        batch_queries.clear()
+        projected_queries.clear()
+        print(f"[main.py] Detected stops layout: {stops_layout} (spatial index: {bbox_index})", flush=True)
+        if bbox_index:
+            await explain_bbox(conn)
+
+
+async def allow_long_query(conn):
+    """Lift the Postgres statement_timeout for the rest of this transaction (streams only)."""
+    if QUERY_TIMEOUT_MS and conn.dialect.name != "sqlite":
+        await conn.execute(text("SET LOCAL statement_timeout = 0"))
+
+
+async def load_stop_index(generation=None):
+    """
+    Load every stop into the in-memory spatial index, in (name, id) order.
+    The STOPS_SNAPSHOT of this generation is mapped if there is one.
+    Otherwise rows are streamed in batches and the CPU-heavy work runs in
+    the threadpool, so the event loop keeps serving while a reload is running.
+    """
+    global stop_index
+    if not queries:
+        print("⚠️ No location columns found, in-memory index not loaded.", flush=True)
+        return
+
+    started = time.perf_counter()
+    if STOPS_SNAPSHOT:
+        try:
+            snapshot = StopIndex.open(STOPS_SNAPSHOT)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Snapshot {STOPS_SNAPSHOT} not usable, loading from the database: {e}", flush=True)
+        else:
+            if snapshot.generation == generation:
+                stop_index = snapshot
+                print(f"✅ Mapped {len(stop_index)} stops from {STOPS_SNAPSHOT} in {time.perf_counter() - started:.3f}s", flush=True)
+                return
+            print(f"⚠️ Snapshot is at generation {snapshot.generation}, not {generation}; loading from the database", flush=True)
+
+    index = StopIndex(cell_size=STOPS_INDEX_CELL_SIZE)
+    async with engine.connect() as conn:
+        await allow_long_query(conn)
+        result = await conn.stream(queries["index_load"])
+        async for rows in result.partitions(50000):
+            await run_in_threadpool(index.extend, rows)
+    await run_in_threadpool(index.finish)
+    stop_index = index
+    print(f"✅ Loaded {len(stop_index)} stops into memory index in {time.perf_counter() - started:.1f}s", flush=True)
+
+
+async def read_generation():
+    """Current data generation from stops_meta ("0" before the first merge)."""
+    try:
+        async with engine.connect() as conn:
+            value = (await conn.execute(text("SELECT value FROM stops_meta WHERE key = 'generation'"))).scalar()
+    except Exception:
+        # stops_meta does not exist until the first merge
+        return "0"
+    return value or "0"
+
+
+async def reload_stop_index(generation):
+    """Rebuild the memory index in the background, then publish the new generation."""
+    global data_generation, generation_checked_at
+    try:
+        await load_stop_index(generation)
+        data_generation = generation
+    except Exception as e:
+        print(f"⚠️ Could not reload in-memory index: {e}", flush=True)
+    generation_checked_at = time.monotonic()
+
+
+async def follow_sqlite_file():
+    """
+    Move the engine to the SQLite file utils/merge.py published last, if
+    that changed. Requests already running finish on the old engine's
+    connections; its pool is closed behind them.
+    """
+    global engine, sqlite_file
+    if sqlite_file is None:
+        return
+    path = sqlite_files.live_path(sqlite_files.database_path(DATABASE_URL))
+    if path == sqlite_file:
+        return
+    try:
+        new_engine = make_engine(f"sqlite:///{path}")
+        async with new_engine.connect() as conn:
+            await conn.execute(text("SELECT 1 FROM stops LIMIT 1"))
+    except Exception as e:
+        print(f"⚠️ Could not open {path}, staying on {sqlite_file}: {e}", flush=True)
+        return
+    print(f"[main.py] Switching database {sqlite_file} → {path}", flush=True)
+    old_engine, engine, sqlite_file = engine, new_engine, path
+    await old_engine.dispose()
+
+
+async def current_generation():
+    """
+    Return the data generation the API is serving, polling the database at
+    most every GENERATION_POLL_SECONDS. When it changes the schema is
+    re-detected and, in memory mode, the index is rebuilt in the background;
+    until that finishes the old generation (and old ETags) stay in use.
+    """
+    global data_generation, generation_checked_at, reload_task
+    if not engine or time.monotonic() - generation_checked_at < GENERATION_POLL_SECONDS:
+        return data_generation
+    if generation_lock.locked():
+        return data_generation
+    async with generation_lock:
+        generation_checked_at = time.monotonic()
+        await follow_sqlite_file()
+        generation = await read_generation()
+        if generation != data_generation:
+            print(f"[main.py] Data generation changed {data_generation} → {generation}", flush=True)
+            await refresh_schema()
+            if stop_index is not None:
+                # Checked again after the reload; don't start a second one meanwhile
+                generation_checked_at = float("inf")
+                reload_task = asyncio.create_task(reload_stop_index(generation))
+            else:
+                data_generation = generation
+    return data_generation
+
+
+def make_engine(url: str):
+    """The API's engine for `url`: pooled, with the SQLite profile and the query timeout hooked in."""
+    connect_args = {}
+    if QUERY_TIMEOUT_MS and not url.startswith("sqlite:"):
+        connect_args["server_settings"] = {"statement_timeout": str(QUERY_TIMEOUT_MS)}
+    new_engine = create_async_engine(
+        async_database_url(url),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        connect_args=connect_args,
+    )
+    if new_engine.dialect.name == "sqlite" and SQLITE_PROFILE == "serving":
+        event.listen(new_engine.sync_engine, "connect", apply_sqlite_profile)
+    if new_engine.dialect.name == "sqlite" and QUERY_TIMEOUT_MS:
+        event.listen(new_engine.sync_engine, "before_cursor_execute", start_query_timer)
+        event.listen(new_engine.sync_engine, "after_cursor_execute", stop_query_timer)
+        event.listen(new_engine.sync_engine, "handle_error", stop_query_timer_on_error)
+    return new_engine
+
 
 @app.on_event("startup")
-def startup():
+async def startup():
     print("[main.py] startup() called", flush=True)
-    global engine
+    global engine, sqlite_file
     if DATABASE_URL:
         max_retries = 10
         for attempt in range(max_retries):
             try:
                 print(f"[main.py] Creating engine for {DATABASE_URL} (attempt {attempt+1}/{max_retries})", flush=True)
-                engine = sqlalchemy.create_engine(DATABASE_URL)
-                with engine.connect() as conn:
-                    conn.execute(text("SELECT 1"))
+                url = DATABASE_URL
+                if url.startswith("sqlite:"):
+                    sqlite_file = sqlite_files.live_path(sqlite_files.database_path(url))
+                    url = f"sqlite:///{sqlite_file}"
+                engine = make_engine(url)
+                async with engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
                     # Ensure the stops table exists
                     if engine.dialect.name == "sqlite":
-                        conn.execute(text("""
+                        await sqlite_self_check(conn)
+                        # The only write the API makes; the profile is read-only
+                        await conn.execute(text("PRAGMA query_only = 0"))
+                        await conn.execute(text("""
                             CREATE TABLE IF NOT EXISTS stops (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                                 name TEXT,
@@ -45,8 +741,11 @@ def startup():
                                 created_at TEXT
                             );
                         """))
+                        await conn.commit()
+                        if SQLITE_PROFILE == "serving":
+                            await conn.execute(text("PRAGMA query_only = 1"))
                     else:
-                        conn.execute(text("""
+                        await conn.execute(text("""
                             CREATE TABLE IF NOT EXISTS stops (
                                 id SERIAL PRIMARY KEY,
                                 name TEXT,
@@ -57,13 +756,23 @@ def startup():
                                 created_at TEXT
                             );
                         """))
-                    conn.commit()
+                    await conn.commit()
                 print("✅ Connected to database and table ensured.", flush=True)
+                await refresh_schema()
+                global data_generation, generation_checked_at
+                data_generation = await read_generation()
+                if STOPS_ENGINE == "memory":
+                    try:
+                        await load_stop_index(data_generation)
+                    except Exception as e:
+                        print(f"⚠️ Could not load in-memory index, serving from SQL: {e}", flush=True)
+                generation_checked_at = time.monotonic()
+                print(f"[main.py] Serving data generation {data_generation}", flush=True)
                 return
             except Exception as e:
                 print(f"⚠️ Could not connect to database (attempt {attempt+1}/{max_retries}): {e}", flush=True)
                 if attempt < max_retries - 1:
-                    time.sleep(2)
+                    await asyncio.sleep(2)
                 else:
                     engine = None
                     print("❌ Giving up on database connection.", flush=True)
@@ -85,6 +794,123 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 print("[main.py] Frontend setup complete", flush=True)
 
+async def fetch_bbox(xmin, xmax, ymin, ymax, limit, offset, order="name", fields=DEFAULT_COLUMNS):
+    """`fields` of the stops inside a bbox ordered by (name, id) or `order`, from the memory index or SQL."""
+    if stop_index is not None:
+        return await run_in_threadpool(
+            stop_index.query, xmin, xmax, ymin, ymax, limit=limit, offset=offset, columns=fields, order=order,
+        )
+
+    statement = queries["bbox"] if order == "name" and fields == DEFAULT_COLUMNS else projected_query("bbox", fields, order)
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            statement,
+            {"xmin": xmin, "xmax": xmax, "ymin": ymin, "ymax": ymax, "limit": limit, "offset": offset},
+        )
+        return [dict(row._mapping) for row in result]
+
+
+class SlotHeldResponse:
+    """Send `response`, then give its query slot back, even if the client goes away."""
+
+    def __init__(self, response: Response, release):
+        self.response = response
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+
+
+@app.middleware("http")
+async def shed_load_middleware(request: Request, call_next):
+    """
+    Run at most QUERY_MAX_CONCURRENCY /api requests at once, each holding
+    its slot until its body is sent. Registered before etag_middleware, so
+    304s are answered without taking a slot.
+    """
+    global queries_in_flight
+    if not request.url.path.startswith("/api/") or request.url.path == "/api/budgets":
+        return await call_next(request)
+
+    try:
+        await asyncio.wait_for(query_slots.acquire(), QUEUE_TIMEOUT_MS / 1000)
+    except asyncio.TimeoutError:
+        budget_hits["shed"] += 1
+        return JSONResponse(
+            {"error": "Server busy, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    queries_in_flight += 1
+
+    def release():
+        global queries_in_flight
+        queries_in_flight -= 1
+        query_slots.release()
+
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
+        raise
+    # call_next returns before the body is produced; a streamed export keeps
+    # its slot until the last chunk is sent
+    return SlotHeldResponse(response, release)
+
+
+def make_etag(generation, request: Request) -> str:
+    """Strong ETag from the data generation, path, normalized query and format."""
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    binary = accepts_binary(request.headers.get("accept", ""))
+    digest = hashlib.sha1(f"{generation}|{request.url.path}|{query}|{binary}".encode("utf-8")).hexdigest()
+    return f'"{generation}-{digest[:20]}"'
+
+
+def if_none_match_tags(header: str) -> List[str]:
+    """
+    The entity tags of an If-None-Match header with any W/ prefix dropped:
+    If-None-Match uses the weak comparison (RFC 9110), and proxies such as
+    nginx weaken our strong tags when they compress the response.
+    """
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        tags.append(tag[2:] if tag.startswith("W/") else tag)
+    return tags
+
+
+@app.middleware("http")
+async def etag_middleware(request: Request, call_next):
+    """Answer If-None-Match with 304 and tag cacheable GET responses."""
+    if request.method != "GET" or not request.url.path.startswith(CACHEABLE_PATHS):
+        return await call_next(request)
+
+    generation = await current_generation()
+    if generation is None:
+        return await call_next(request)
+
+    etag = make_etag(generation, request)
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in if_none_match_tags(if_none_match):
+        return Response(status_code=304, headers={
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={CACHE_MAX_AGE}",
+            "Vary": "Accept",
+        })
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers["ETag"] = etag
+        response.headers.setdefault("Cache-Control", f"public, max-age={CACHE_MAX_AGE}")
+        response.headers["Vary"] = "Accept"
+    return response
+
+
+# Added last, so it wraps the other middleware: the shed 503 and the 304
+# carry the CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -99,115 +925,603 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Nearest-Radius-M", "ETag"],
 )
 
+
 # --- 1️⃣ Bounding box API endpoint ---
+# ?format= values of /api/stops
+JSON_FORMATS = ("json",)
+BINARY_FORMATS = ("bin", "binary", "columnar")
+
+
+def accepts_binary(accept: str) -> bool:
+    """
+    Whether an Accept header prefers the columnar binary encoding to JSON:
+    it must be named with q > 0, and at least as high as JSON or a wildcard.
+    """
+    binary_q = json_q = 0.0
+    for part in accept.split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_type = media_type.lower()
+        if media_type == stops_binary.MEDIA_TYPE:
+            binary_q = max(binary_q, q)
+        elif media_type in ("application/json", "application/*", "*/*"):
+            json_q = max(json_q, q)
+    return binary_q > 0 and binary_q >= json_q
+
+
+def wants_binary(request: Request, format: str) -> bool:
+    """Content negotiation between JSON and the columnar binary encoding; ValueError for an unknown format."""
+    if format:
+        if format.lower() in BINARY_FORMATS:
+            return True
+        if format.lower() in JSON_FORMATS:
+            return False
+        raise ValueError(f"format must be one of {', '.join(JSON_FORMATS + BINARY_FORMATS)}")
+    return accepts_binary(request.headers.get("accept", ""))
+
+
 @app.get("/api/stops")
-def api_stops(
+async def api_stops(
+    request: Request,
     xmin: float = Query(...),
     xmax: float = Query(...),
     ymin: float = Query(...),
     ymax: float = Query(...),
-    limit: int = Query(10000),
-    offset: int = Query(0),
+    limit: int = Query(10000, ge=0),
+    offset: int = Query(0, ge=0),
+    format: str = Query(None),
+    order: str = Query("name"),
+    zoom: int = Query(None),
+    fields: str = Query(None),
+    precision: int = Query(None, ge=0, le=MAX_PRECISION),
 ):
-    """Return stops within a bounding box"""
+    """
+    Return stops within a bounding box.
+
+    JSON by default; `?format=bin` or `Accept: application/x-stops-columnar`
+    returns the columnar binary encoding from utils/stops_binary.py.
+    `?order=spatial` or `?order=none` skip the sort by name (see BBOX_ORDERS).
+    `?zoom` is the client's map zoom; it tightens the area budget.
+    `?fields=lon,lat` selects only some of STOP_FIELDS, `?precision=5`
+    rounds the coordinates.
+    """
     print(f"[main.py] GET /api/stops bbox=({xmin},{xmax},{ymin},{ymax})", flush=True)
-    if not engine:
+    if stop_index is None and not engine:
         return JSONResponse({"error": "Database not configured"}, status_code=500)
 
     try:
-        with engine.connect() as conn:
-            # Get column names in a DB-agnostic way
-            if engine.dialect.name == "sqlite":
-                cols = [row[1] for row in conn.execute(text("PRAGMA table_info('stops');"))]
+        if stop_index is None and not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+        if order not in BBOX_ORDERS:
+            return JSONResponse({"error": f"order must be one of {', '.join(BBOX_ORDERS)}"}, status_code=400)
+        if order == "spatial" and not spatial_ready:
+            return JSONResponse({"error": "Spatial order not available, run utils.merge"}, status_code=503)
+        too_large = check_area(xmin, xmax, ymin, ymax, zoom)
+        if too_large:
+            return too_large
+        try:
+            binary = wants_binary(request, format)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        try:
+            columns = parse_fields(fields, STOP_FIELDS, DEFAULT_COLUMNS)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        if binary and columns != DEFAULT_COLUMNS:
+            return JSONResponse({"error": "fields is not supported by the binary format"}, status_code=400)
+
+        stops = await fetch_bbox(xmin, xmax, ymin, ymax, clamp_limit(limit), offset, order=order, fields=columns)
+        print(f"[main.py] Returning {len(stops)} stops", flush=True)
+
+        def render():
+            round_coordinates(stops, precision)
+            if binary:
+                return Response(stops_binary.encode(stops), media_type=stops_binary.MEDIA_TYPE)
+            return JSONResponse(stops)
+        return await run_in_threadpool(render)
+
+    except Exception as e:
+        return query_error(e)
+
+class BatchBBox(BaseModel):
+    xmin: float
+    xmax: float
+    ymin: float
+    ymax: float
+    # Negative would be LIMIT -1: no limit on SQLite, an error on Postgres
+    limit: int = Field(10000, ge=0)
+    zoom: Optional[int] = None
+
+
+class BatchRequest(BaseModel):
+    bboxes: List[BatchBBox]
+    dedupe: bool = False
+    fields: Optional[List[str]] = None
+    precision: Optional[int] = Field(None, ge=0, le=MAX_PRECISION)
+
+
+async def fetch_bbox_batch(bboxes: List[BatchBBox], dedupe: bool, fields=DEFAULT_COLUMNS):
+    """
+    `fields` of the stops in every bbox, each ordered by (name, id) and cut
+    at its own limit. With dedupe a stop is only returned for the first bbox
+    that contains it.
+    """
+    seen = set()
+    if stop_index is not None:
+        def query_index():
+            results = []
+            for box in bboxes:
+                ranks = stop_index.query_ranks(box.xmin, box.xmax, box.ymin, box.ymax, limit=box.limit)
+                if dedupe:
+                    ranks = [r for r in ranks if r not in seen]
+                    seen.update(ranks)
+                results.append(stop_index.rows(ranks, fields))
+            return results
+        return await run_in_threadpool(query_index)
+
+    statement = batch_queries.get((len(bboxes), fields))
+    if statement is None:
+        statement = batch_queries[(len(bboxes), fields)] = prepare_batch_query(stops_layout, len(bboxes), bbox_index, fields)
+    params = {}
+    for i, box in enumerate(bboxes):
+        params.update({f"xmin_{i}": box.xmin, f"xmax_{i}": box.xmax, f"ymin_{i}": box.ymin,
+                       f"ymax_{i}": box.ymax, f"limit_{i}": box.limit})
+
+    results = [[] for _ in bboxes]
+    async with engine.connect() as conn:
+        for q, stop_id, _, *values in await conn.execute(statement, params):
+            if dedupe:
+                if stop_id in seen:
+                    continue
+                seen.add(stop_id)
+            results[q].append(dict(zip(fields, values)))
+    return results
+
+
+@app.post("/api/stops/batch")
+async def api_stops_batch(batch: BatchRequest):
+    """
+    Return the stops of many bboxes in one request, one list per bbox in
+    request order. Set `dedupe` to drop stops already returned for an
+    earlier, overlapping bbox. `fields` and `precision` work as on /api/stops.
+    """
+    print(f"[main.py] POST /api/stops/batch bboxes={len(batch.bboxes)} dedupe={batch.dedupe}", flush=True)
+    if not batch.bboxes:
+        return []
+    if len(batch.bboxes) > BATCH_MAX_BBOXES:
+        return JSONResponse({"error": f"At most {BATCH_MAX_BBOXES} bboxes per batch"}, status_code=400)
+    if stop_index is None and not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+
+    try:
+        if stop_index is None and not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+        for box in batch.bboxes:
+            too_large = check_area(box.xmin, box.xmax, box.ymin, box.ymax, box.zoom)
+            if too_large:
+                return too_large
+            box.limit = clamp_limit(box.limit)
+        try:
+            fields = parse_fields(batch.fields, STOP_FIELDS, DEFAULT_COLUMNS)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        results = await fetch_bbox_batch(batch.bboxes, batch.dedupe, fields)
+        print(f"[main.py] Returning {sum(len(r) for r in results)} stops in {len(results)} bboxes", flush=True)
+
+        def render():
+            for stops in results:
+                round_coordinates(stops, batch.precision)
+            return JSONResponse(results)
+        return await run_in_threadpool(render)
+
+    except Exception as e:
+        return query_error(e)
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    """Great-circle distance in metres."""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def within_radius(candidates, lon, lat, r):
+    """The candidates within r metres of (lon, lat), each with its distance_m, nearest first."""
+    found = []
+    for stop in candidates:
+        distance = haversine_m(lon, lat, stop["lon"], stop["lat"])
+        if distance <= r:
+            stop["distance_m"] = round(distance, 1)
+            found.append(stop)
+    found.sort(key=lambda stop: (stop["distance_m"], stop["name"] or ""))
+    return found
+
+
+async def fetch_candidates(xmin, xmax, ymin, ymax):
+    """Every stop inside a bbox (up to NEAREST_MAX_CANDIDATES), in no particular order."""
+    if stop_index is not None:
+        return await run_in_threadpool(stop_index.query, xmin, xmax, ymin, ymax, limit=NEAREST_MAX_CANDIDATES)
+
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            queries["bbox_unordered"],
+            {"xmin": xmin, "xmax": xmax, "ymin": ymin, "ymax": ymax, "limit": NEAREST_MAX_CANDIDATES},
+        )
+        return [dict(row._mapping) for row in result]
+
+
+@app.get("/api/stops/nearest")
+async def api_nearest_stops(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1),
+    radius_m: float = Query(1000, gt=0),
+):
+    """
+    Return the k stops closest to a point, within radius_m, nearest first.
+
+    The search box starts small and doubles until it holds k stops within
+    its inscribed circle (so nothing outside it can be closer) or reaches
+    radius_m. Candidates are ranked by haversine distance. A box with
+    NEAREST_MAX_CANDIDATES stops or more is never ranked; the radius is
+    bisected back towards the last box read in full instead, and if that
+    leaves fewer than k stops, X-Nearest-Radius-M says how far was searched.
+    """
+    print(f"[main.py] GET /api/stops/nearest lat={lat} lon={lon} k={k} radius_m={radius_m}", flush=True)
+    if stop_index is None and not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+
+    k = min(k, NEAREST_MAX_K)
+    radius_m = min(radius_m, NEAREST_MAX_RADIUS_M)
+    meters_per_deg = math.pi * EARTH_RADIUS_M / 180.0
+    cos_lat = max(math.cos(math.radians(lat)), 0.01)
+
+    try:
+        if stop_index is None and not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+
+        r = min(NEAREST_START_M, radius_m)
+        complete_r, found = 0.0, []  # largest box read in full, and its stops within complete_r
+        capped_r = None  # smallest box holding NEAREST_MAX_CANDIDATES or more
+        while True:
+            dlat = r / meters_per_deg
+            dlon = min(r / (meters_per_deg * cos_lat), 180.0)
+            candidates = await fetch_candidates(lon - dlon, lon + dlon, lat - dlat, lat + dlat)
+            if len(candidates) >= NEAREST_MAX_CANDIDATES:
+                # A truncated, unordered subset may miss closer stops: never rank it
+                capped_r = r
             else:
-                cols = [row[0] for row in conn.execute(text("""
-                        SELECT column_name
-                        FROM information_schema.columns
-                        WHERE table_name='stops';
-                    """))]
-
-            if "lon" in cols and "lat" in cols:
-                query = text("""
-                    SELECT name, bearing, lon, lat
-                    FROM stops
-                    WHERE lon BETWEEN :xmin AND :xmax
-                    AND lat BETWEEN :ymin AND :ymax
-                    ORDER BY name
-                    LIMIT :limit OFFSET :offset
-                """)
-            elif "location" in cols:
-                query = text("""
-                    SELECT name, bearing, location[1] AS lon, location[2] AS lat
-                    FROM stops
-                    WHERE location[1] BETWEEN :xmin AND :xmax
-                    AND location[2] BETWEEN :ymin AND :ymax
-                    ORDER BY name
-                    LIMIT :limit OFFSET :offset
-                """)
+                complete_r, found = r, await run_in_threadpool(within_radius, candidates, lon, lat, r)
+                if len(found) >= k or r >= radius_m:
+                    break
+            if capped_r is None:
+                r = min(r * 2, radius_m)
+            elif capped_r - complete_r <= max(capped_r / 64, 1.0):
+                break
             else:
-                return JSONResponse({"error": "No location columns found"}, status_code=500)
+                r = (complete_r + capped_r) / 2
 
-            result = conn.execute(
-                query,
-                {"xmin": xmin, "xmax": xmax, "ymin": ymin, "ymax": ymax, "limit": limit, "offset": offset},
-            )
-            stops = [dict(row._mapping) for row in result]
-            print(f"[main.py] Returning {len(stops)} stops", flush=True)
-            return stops
+        headers = {}
+        if len(found) < k and complete_r < radius_m and capped_r is not None:
+            # Fewer than k stops, but only because the search had to stop short of radius_m
+            headers["X-Nearest-Radius-M"] = f"{complete_r:.0f}"
+            print(f"⚠️ Nearest search capped at {complete_r:.0f}m by NEAREST_MAX_CANDIDATES", flush=True)
+        print(f"[main.py] Returning {min(len(found), k)} nearest stops (searched {complete_r:.0f}m)", flush=True)
+        return await render_json(found[:k], headers=headers)
 
     except Exception as e:
-        print(f"⚠️ Query failed: {e}", flush=True)
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return query_error(e)
+
+
+@app.get("/api/stops/search")
+async def api_search_stops(
+    q: str = Query(...),
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1),
+):
+    """
+    Return stops whose name contains every word of q, the last one as a
+    prefix, ignoring case, accents and apostrophes. Names starting with q
+    come first, shortest first among the first SEARCH_RANK_WINDOW of them;
+    other matches fill the page in index order.
+    """
+    print(f"[main.py] GET /api/stops/search q={q!r} limit={limit}", flush=True)
+    if not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+
+    tokens = search.query_tokens(q)
+    if not tokens:
+        return []
+    if engine.dialect.name == "sqlite":
+        params = {"match": search.fts5_match(tokens), "starts": search.fts5_starts(tokens)}
+    else:
+        params = {"match": search.pg_tsquery(tokens), "starts": search.pg_starts(tokens)}
+    limit = min(limit, SEARCH_MAX_LIMIT)
+
+    try:
+        if not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+        if not search_ready:
+            return JSONResponse({"error": "Search index not built, run utils.merge"}, status_code=503)
+
+        async with engine.connect() as conn:
+            result = await conn.execute(queries["search_starts"], {**params, "limit": max(SEARCH_RANK_WINDOW, limit)})
+            rows = [dict(row._mapping) for row in result]
+            if len(rows) < limit:
+                # Few names start with q, so excluding them is cheap
+                result = await conn.execute(queries["search_rest"], {**params, "limit": limit - len(rows)})
+                rows += [dict(row._mapping) for row in result]
+        stops = (await run_in_threadpool(search.rank, rows, tokens))[:limit]
+        print(f"[main.py] Returning {len(stops)} stops", flush=True)
+        return await render_json(stops)
+
+    except Exception as e:
+        return query_error(e)
+
 
 # --- 2️⃣ Paginated list API endpoint ---
+def encode_cursor(name, stop_id) -> str:
+    """Opaque keyset cursor pointing just after the (name, id) of a row."""
+    raw = json.dumps([name, stop_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    name, stop_id = json.loads(raw)
+    if not (name is None or isinstance(name, str)) or not isinstance(stop_id, int):
+        raise ValueError("malformed cursor")
+    return name, stop_id
+
+
 @app.get("/api/allstops")
-def api_all_stops(
-    limit: int = Query(5000),
-    offset: int = Query(0),
+async def api_all_stops(
+    limit: int = Query(5000, ge=0),
+    offset: int = Query(0, ge=0),
+    cursor: str = Query(None),
 ):
-    """Return all stops paginated"""
-    print(f"[main.py] GET /api/allstops limit={limit} offset={offset}", flush=True)
+    """
+    Return all stops paginated.
+
+    Pages can be fetched by `offset`, or by following the opaque `cursor`
+    returned in the X-Next-Cursor header, which seeks on (name, id) and costs
+    the same for every page.
+    """
+    print(f"[main.py] GET /api/allstops limit={limit} offset={offset} cursor={cursor}", flush=True)
     if not engine:
         return JSONResponse({"error": "Database not configured"}, status_code=500)
 
+    limit = clamp_limit(limit)
+    params = {"limit": limit, "offset": offset}
+    query_name = "all"
+    if cursor:
+        try:
+            params["after_name"], params["after_id"] = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+        params["offset"] = 0
+        query_name = "all_after" if params["after_name"] is not None else "all_after_null"
+
     try:
-        with engine.connect() as conn:
-            if engine.dialect.name == "sqlite":
-                cols = [row[1] for row in conn.execute(text("PRAGMA table_info('stops');"))]
-            else:
-                cols = [row[0] for row in conn.execute(text("""
-                        SELECT column_name
-                        FROM information_schema.columns
-                        WHERE table_name='stops';
-                    """))]
-
-            if "lon" in cols and "lat" in cols:
-                query = text("""
-                    SELECT name, bearing, lon, lat
-                    FROM stops
-                    ORDER BY name
-                    LIMIT :limit OFFSET :offset
-                """)
-            elif "location" in cols:
-                query = text("""
-                    SELECT name, bearing, location[1] AS lon, location[2] AS lat
-                    FROM stops
-                    ORDER BY name
-                    LIMIT :limit OFFSET :offset
-                """)
-            else:
-                return JSONResponse({"error": "No location columns found"}, status_code=500)
+        if not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
 
-            result = conn.execute(query, {"limit": limit, "offset": offset})
+        async with engine.connect() as conn:
+            result = await conn.execute(queries[query_name], params)
             stops = [dict(row._mapping) for row in result]
+
+            headers = {}
+            if stops and len(stops) == limit:
+                headers["X-Next-Cursor"] = encode_cursor(stops[-1]["name"], stops[-1]["id"])
+            for stop in stops:
+                del stop["id"]
             print(f"[main.py] Returning {len(stops)} stops", flush=True)
-            return stops
+            return await render_json(stops, headers=headers)
 
     except Exception as e:
-        print(f"⚠️ Query failed: {e}", flush=True)
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return query_error(e)
+
+
+# --- 🔵 Cluster endpoint for zoomed-out views ---
+@app.get("/api/clusters")
+async def api_clusters(
+    xmin: float = Query(...),
+    xmax: float = Query(...),
+    ymin: float = Query(...),
+    ymax: float = Query(...),
+    zoom: int = Query(...),
+    limit: int = Query(10000, ge=0),
+):
+    """Return precomputed stop clusters (centroid, count, dominant source) for a bbox"""
+    print(f"[main.py] GET /api/clusters bbox=({xmin},{xmax},{ymin},{ymax}) zoom={zoom}", flush=True)
+    if not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+
+    zoom = max(0, min(zoom, CLUSTER_MAX_ZOOM))
+    cx0, cx1, cy0, cy1 = cell_range(xmin, xmax, ymin, ymax, zoom)
+    try:
+        if not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+        if not clusters_ready:
+            return JSONResponse({"error": "Clusters not built, run utils.merge"}, status_code=503)
+
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                queries["clusters"],
+                {"zoom": zoom, "cx0": cx0, "cx1": cx1, "cy0": cy0, "cy1": cy1, "limit": clamp_limit(limit)},
+            )
+            clusters = [dict(row._mapping) for row in result]
+            print(f"[main.py] Returning {len(clusters)} clusters", flush=True)
+            return await render_json(clusters)
+
+    except Exception as e:
+        return query_error(e)
+
+
+# --- 🗺️ Vector tile endpoint ---
+@app.get("/api/tiles/{z}/{x}/{y}.mvt")
+async def api_tile(z: int, x: int, y: int):
+    """Return the stops in a Web Mercator tile as a Mapbox Vector Tile"""
+    print(f"[main.py] GET /api/tiles/{z}/{x}/{y}.mvt", flush=True)
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return JSONResponse({"error": "Invalid tile coordinates"}, status_code=400)
+    if stop_index is None and not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+
+    headers = {"Cache-Control": f"public, max-age={MVT_CACHE_SECONDS}"}
+    if z < MVT_MIN_ZOOM:
+        return Response(b"", media_type=MVT_MEDIA_TYPE, headers=headers)
+
+    xmin, xmax, ymin, ymax = tile_bounds(z, x, y)
+    pad_x = (xmax - xmin) * MVT_BUFFER / DEFAULT_EXTENT
+    pad_y = (ymax - ymin) * MVT_BUFFER / DEFAULT_EXTENT
+    try:
+        if stop_index is None and not queries:
+            return JSONResponse({"error": "No location columns found"}, status_code=500)
+        # Spatial order spreads the MVT_TILE_LIMIT rows over the whole tile
+        # instead of taking the names that sort first
+        stops = await fetch_bbox(xmin - pad_x, xmax + pad_x, ymin - pad_y, ymax + pad_y, MVT_TILE_LIMIT, 0,
+                                 order="spatial" if spatial_ready else "name",
+                                 fields=("name", "bearing", "source", "lon", "lat"))
+    except Exception as e:
+        return query_error(e)
+
+    # Below full detail keep only the first stop (in zkey order, or by name,
+    # id before the merge stored zkeys) per grid cell; the cell halves with
+    # every zoom level until each stop gets its own.
+    cell = 0 if z >= MVT_FULL_ZOOM else min(256, 8 << (MVT_FULL_ZOOM - z))
+
+    def encode_tile():
+        taken = set()
+        features = []
+        for stop in stops:
+            px, py = project(stop["lon"], stop["lat"], z, x, y)
+            if cell:
+                key = (px // cell, py // cell)
+                if key in taken:
+                    continue
+                taken.add(key)
+            features.append((px, py, {"name": stop["name"], "bearing": stop["bearing"], "source": stop["source"]}))
+        print(f"[main.py] Returning tile with {len(features)} of {len(stops)} stops", flush=True)
+        return encode_point_layer("stops", features)
+
+    return Response(await run_in_threadpool(encode_tile), media_type=MVT_MEDIA_TYPE, headers=headers)
+
+
+# --- 📤 Streaming export ---
+class ExportResponse(StreamingResponse):
+    """
+    A StreamingResponse that closes its generator as soon as it stops, even
+    when the client went away, so the export's connection goes straight back
+    to the pool instead of waiting for garbage collection.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+
+async def stream_export(source, fields=EXPORT_FIELDS, precision=None):
+    """Yield `fields` of the stops table as NDJSON, one chunk of EXPORT_CHUNK_ROWS lines at a time."""
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    exported = 0
+    started = time.perf_counter()
+    conn = await engine.connect()
+    try:
+        await allow_long_query(conn)
+        statement = projected_query("export", fields, bool(source))
+        result = await conn.stream(statement, {"source": source} if source else {})
+        keys = list(result.keys())
+        partitions = result.partitions(EXPORT_CHUNK_ROWS)
+        while True:
+            # A fetch cut short by the client's cancellation leaves the pooled
+            # connection half-closed: let it finish, the next yield stops us
+            with anyio.CancelScope(shield=True):
+                rows = await anext(partitions, None)
+            if rows is None:
+                break
+            exported += len(rows)
+            stops = round_coordinates([dict(zip(keys, row)) for row in rows], precision)
+            yield ("\n".join(encode(stop) for stop in stops) + "\n").encode("utf-8")
+    except (asyncio.CancelledError, GeneratorExit):
+        print(f"⚠️ Export cancelled by the client after {exported} rows", flush=True)
+        raise
+    except Exception as e:
+        # Headers are already sent: re-raise so the connection is aborted
+        # instead of ending the chunked body as if the file were complete
+        print(f"⚠️ Export failed after {exported} rows: {e}", flush=True)
+        raise
+    finally:
+        with anyio.CancelScope(shield=True):
+            await conn.close()
+    print(f"[main.py] Exported {exported} stops in {time.perf_counter() - started:.1f}s", flush=True)
+
+
+@app.get("/api/export.ndjson")
+async def api_export(
+    source: str = Query(None),
+    fields: str = Query(None),
+    precision: int = Query(None, ge=0, le=MAX_PRECISION),
+):
+    """Stream every stop (optionally one source) as newline-delimited JSON, `fields` and `precision` as on /api/stops"""
+    print(f"[main.py] GET /api/export.ndjson source={source} fields={fields}", flush=True)
+    if not engine:
+        return JSONResponse({"error": "Database not configured"}, status_code=500)
+    if not queries:
+        return JSONResponse({"error": "No location columns found"}, status_code=500)
+    try:
+        columns = parse_fields(fields, EXPORT_FIELDS, EXPORT_FIELDS)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    return ExportResponse(
+        stream_export(source, columns, precision),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": export_disposition(source)},
+    )
+
+
+def export_disposition(source) -> str:
+    """
+    Content-Disposition of an export. `source` is user input: the plain
+    filename keeps only safe ASCII, the RFC 5987 filename* carries it intact.
+    """
+    if not source:
+        return 'attachment; filename="stops.ndjson"'
+    safe = re.sub(r"[^A-Za-z0-9._-]", "_", source)
+    return f"attachment; filename=\"stops-{safe}.ndjson\"; filename*=UTF-8''{quote(f'stops-{source}.ndjson', safe='')}"
+
+
+# --- 🚦 Query budgets ---
+@app.get("/api/budgets")
+async def api_budgets():
+    """Current query budgets, how often each was hit, and the /api requests in flight"""
+    return {
+        "budgets": {
+            "query_max_limit": QUERY_MAX_LIMIT,
+            "bbox_max_area": BBOX_MAX_AREA,
+            "bbox_viewport_tiles": BBOX_VIEWPORT_TILES,
+            "query_timeout_ms": QUERY_TIMEOUT_MS,
+            "query_max_concurrency": QUERY_MAX_CONCURRENCY,
+            "queue_timeout_ms": QUEUE_TIMEOUT_MS,
+        },
+        "hits": budget_hits,
+        "in_flight": queries_in_flight,
+    }
 
 
 # --- 3️⃣ Viewer page ---
@@ -216,68 +1530,85 @@ def stops_page(request: Request):
     print("[main.py] GET /stops called", flush=True)
     return templates.TemplateResponse("stops.html", {"request": request})
 
+
+async def read_source_stats():
+    """
+    Per-source stats keyed by source, from the source_stats table written by
+    utils/merge.py. Databases last merged before that table existed fall back
+    to counting the stops table.
+    """
+    try:
+        async with engine.connect() as conn:
+            rows = await conn.execute(text("SELECT * FROM source_stats"))
+            return {row.source: dict(row._mapping) for row in rows}
+    except Exception as e:
+        print(f"⚠️ source_stats unavailable, counting stops instead: {e}", flush=True)
+
+    async with engine.connect() as conn:
+        rows = await conn.execute(text("""
+            SELECT source, COUNT(*) AS stops_count, MAX(created_at) AS last_update
+            FROM stops
+            GROUP BY source
+        """))
+        return {row.source: dict(row._mapping) for row in rows}
+
+
 @app.get("/data", response_class=JSONResponse)
-def data_page():
+async def data_page():
     if not engine:
         return JSONResponse({"error": "Database not configured"}, status_code=500)
 
     try:
-        with engine.connect() as conn:
-            # Get total stops per source
-            source_counts = conn.execute(text("""
-                SELECT source, COUNT(*) as count 
-                FROM stops 
-                GROUP BY source
-            """))
-            source_counts = {row.source: row.count for row in source_counts}
-
-            # Get most recent update timestamp
-            last_update = conn.execute(text("""
-                SELECT MAX(created_at) as last_update 
-                FROM stops
-            """)).scalar()
-
-            total_stops = sum(source_counts.values())
-
-            # Create data sources list with actual counts
-            data_sources = []
-            source_urls = {
-                "UK": "https://bustimes.org/api/stops/",
-                "Finland": "https://api.digitransit.fi/routing/v2/finland/gtfs/v1",
-                "HSL": "https://api.digitransit.fi/routing/v2/hsl/gtfs/v1",
-                "VARELY": "https://api.digitransit.fi/routing/v2/varely/gtfs/v1",
-                "Waltti": "https://api.digitransit.fi/routing/v2/waltti/gtfs/v1",
-                "France": "https://transport.data.gouv.fr/api/gtfs-stops",
-                "Italy": "https://busmaps.com/en/italy/feedlist",
-                "Slovakia": "https://busmaps.com/en/slovakia/feedlist",
-                "Poland": "https://dev-portal.at.govt.nz/GTFS-API",
-                "Greece": "https://busmaps.com/en/greece/feedlist",
-                "Switzerland": "https://data.oev-info.ch/explore/dataset/stop-points-today/",
-                "Jersey": "https://github.com/jclgoodwin/bustimes.org/blob/main/busstops/jersey-bus-stops.json",
-                "Germany": "https://download.gtfs.de/germany/free/latest.zip",
-                "Netherlands": "https://gtfs.ovapi.nl/nl/",
-                "Luxembourg": "https://data.public.lu/en/datasets/horaires-et-arrets-des-transport-publics-gtfs/",
-                "Sweden": "https://api.resrobot.se/v2.1/gtfs/sweden.zip",
-                "Guernsey": "https://ticketless-app.api.urbanthings.cloud/api/2/transit/stops/",
-                "Australia": "https://busmaps.com/en/australia/feedlist",
-                "Iceland": "https://opendata.straeto.is/data/gtfs/",
-                "singapore": "https://data.gov.sg/datasets/d_3f172c6feb3f4f92a2f47d93eed2908a/view",
-                "Auckland": "https://gtfs.at.govt.nz/gtfs.zip",
-                "New Zealand": "https://gtfs.at.govt.nz/gtfs.zip",
-                "Tenerife": "https://datos.tenerife.es/ckan/dataset/36c2e26f-0d18-4b5a-b214-1636168e0765/resource/9f291323-8b78-453a-9008-4f0e3bfb3ce3/download/fichero-zip-de-google-transit.zip",
-            }
+        stats = await read_source_stats()
+        total_stops = sum(row["stops_count"] for row in stats.values())
+        last_update = max((row["last_update"] for row in stats.values() if row["last_update"]), default=None)
 
-            for source, url in source_urls.items():
-                if source.lower() == "uk":
-                    source = "ukbuses"
-                else:
-                    source = source.lower()
-                data_sources.append({
-                    "source": source,
-                    "stops_count": source_counts.get(source, 0),
-                    "source_url": url
-                })
+        # Create data sources list with actual counts
+        data_sources = []
+        source_urls = {
+            "UK": "https://bustimes.org/api/stops/",
+            "Finland": "https://api.digitransit.fi/routing/v2/finland/gtfs/v1",
+            "HSL": "https://api.digitransit.fi/routing/v2/hsl/gtfs/v1",
+            "VARELY": "https://api.digitransit.fi/routing/v2/varely/gtfs/v1",
+            "Waltti": "https://api.digitransit.fi/routing/v2/waltti/gtfs/v1",
+            "France": "https://transport.data.gouv.fr/api/gtfs-stops",
+            "Italy": "https://busmaps.com/en/italy/feedlist",
+            "Slovakia": "https://busmaps.com/en/slovakia/feedlist",
+            "Poland": "https://dev-portal.at.govt.nz/GTFS-API",
+            "Greece": "https://busmaps.com/en/greece/feedlist",
+            "Switzerland": "https://data.oev-info.ch/explore/dataset/stop-points-today/",
+            "Jersey": "https://github.com/jclgoodwin/bustimes.org/blob/main/busstops/jersey-bus-stops.json",
+            "Germany": "https://download.gtfs.de/germany/free/latest.zip",
+            "Netherlands": "https://gtfs.ovapi.nl/nl/",
+            "Luxembourg": "https://data.public.lu/en/datasets/horaires-et-arrets-des-transport-publics-gtfs/",
+            "Sweden": "https://api.resrobot.se/v2.1/gtfs/sweden.zip",
+            "Guernsey": "https://ticketless-app.api.urbanthings.cloud/api/2/transit/stops/",
+            "Australia": "https://busmaps.com/en/australia/feedlist",
+            "Iceland": "https://opendata.straeto.is/data/gtfs/",
+            "singapore": "https://data.gov.sg/datasets/d_3f172c6feb3f4f92a2f47d93eed2908a/view",
+            "Auckland": "https://gtfs.at.govt.nz/gtfs.zip",
+            "New Zealand": "https://gtfs.at.govt.nz/gtfs.zip",
+            "Tenerife": "https://datos.tenerife.es/ckan/dataset/36c2e26f-0d18-4b5a-b214-1636168e0765/resource/9f291323-8b78-453a-9008-4f0e3bfb3ce3/download/fichero-zip-de-google-transit.zip",
+        }
 
+        for source, url in source_urls.items():
+            if source.lower() == "uk":
+                source = "ukbuses"
+            else:
+                source = source.lower()
+            row = stats.get(source, {})
+            entry = {
+                "source": source,
+                "stops_count": row.get("stops_count", 0),
+                "source_url": url
+            }
+            if "min_lon" in row:
+                entry["extent"] = [row["min_lon"], row["min_lat"], row["max_lon"], row["max_lat"]]
+                entry["last_update"] = row["last_update"]
+                entry["fetch_seconds"] = row["fetch_seconds"]
+                entry["bytes_downloaded"] = row["bytes_downloaded"]
+                entry["updated_at"] = row["updated_at"]
+            data_sources.append(entry)
 
     except Exception as e:
         print(f"⚠️ Query failed: {e}", flush=True)
@@ -2,7 +2,7 @@ print("[uk.py] Module loading...", flush=True)
 
 import asyncio
 import random
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, List, Optional, Dict, Any
 import httpx
 
 print("[uk.py] Imports done", flush=True)
@@ -19,9 +19,9 @@ async def fetch_uk(
     client: Optional[httpx.AsyncClient] = None,
     timeout: int = 30,
     debug: bool = False,   # 👈 added flag
-) -> List[Dict[str, Any]]:
+) -> AsyncIterator[List[Dict[str, Any]]]:
     """
-    Fetch stops from ukbuses.org and return a normalized list.
+    Fetch stops from ukbuses.org, yielding a normalized list per API page.
 
     Parameters
     ----------
@@ -33,9 +33,9 @@ async def fetch_uk(
     debug : bool
         If True, only fetches the first page for faster testing.
 
-    Returns
-    -------
-    list of dicts with keys: id, name, lat, lon, bearing, source
+    Yields
+    ------
+    lists of dicts with keys: id, name, lat, lon, bearing, source
     """
     print("[uk.py] fetch_uk: Starting fetch from ukbuses.org...", flush=True)
     close_client = False
@@ -57,7 +57,7 @@ async def fetch_uk(
             print(f"[uk.py] fetch_uk: Using bbox params: {params}", flush=True)
 
         url = UKBUSES_BASE # + "?no_inactive=true&contains_delete=true"
-        results: List[Dict[str, Any]] = []
+        fetched = 0
         page = 1
 
         while url:
@@ -80,6 +80,7 @@ async def fetch_uk(
             page_results = data.get("results", [])
             print(f"[uk.py] fetch_uk: Got {len(page_results)} results from page {page}", flush=True)
 
+            results: List[Dict[str, Any]] = []
             for item in page_results:
                 loc = item.get("location") or []
                 lon = None
@@ -97,6 +98,8 @@ async def fetch_uk(
                     "source": "ukbuses",
                 }
                 results.append(normalized)
+            fetched += len(results)
+            yield results
 
             # Stop early if debug mode is enabled
             if debug:
@@ -118,8 +121,7 @@ async def fetch_uk(
             params = None
             page += 1
 
-        print(f"[uk.py] fetch_uk: Fetched {len(results)} UK stops from ukbuses.org", flush=True)
-        return results
+        print(f"[uk.py] fetch_uk: Fetched {fetched} UK stops from ukbuses.org", flush=True)
 
     finally:
         if close_client:
@@ -0,0 +1,76 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+# main.py mounts static/ and templates/ relative to the working directory
+os.chdir(BACKEND)
+
+from utils.spatial_order import zkey
+
+STOPS_SCHEMA = """
+    CREATE TABLE stops (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        bearing TEXT,
+        lon REAL,
+        lat REAL,
+        source TEXT,
+        created_at TEXT,
+        zkey INTEGER,
+        stop_id TEXT
+    );
+"""
+
+
+def synthetic_stops(count: int, seed: int = 1):
+    """
+    (name, bearing, lon, lat, source, created_at, zkey, stop_id) rows in a
+    10x10 degree square, with repeated names, NULL names and bearings, stops
+    sharing a point and a few without coordinates.
+    """
+    rng = random.Random(seed)
+    names = ["Main Street", "Station", "Église", "Zürich HB", "market", "Harbour", "Mill Lane", "Älvsjö"]
+    rows = []
+    for i in range(count):
+        if i % 50 == 7:
+            lon, lat = 5.0, 5.0
+        else:
+            lon, lat = round(rng.uniform(0, 10), 6), round(rng.uniform(0, 10), 6)
+        name = None if rng.random() < 0.05 else f"{rng.choice(names)} {rng.randrange(40)}"
+        bearing = None if rng.random() < 0.3 else rng.choice(["N", "S", "E", "W"])
+        if i % 97 == 3:
+            lon = lat = None
+        key = zkey(lon, lat) if lon is not None else None
+        rows.append((name, bearing, lon, lat, rng.choice(["uk", "hsl"]), "2026-01-01T00:00:00", key, f"s{i}"))
+    return rows
+
+
+def seed_database(path: str, rows, rtree: bool = False):
+    """Create an SQLite stops table like utils.merge writes and fill it with `rows`."""
+    conn = sqlite3.connect(path)
+    conn.execute(STOPS_SCHEMA)
+    conn.executemany(
+        "INSERT INTO stops (name, bearing, lon, lat, source, created_at, zkey, stop_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+        rows,
+    )
+    conn.execute("CREATE INDEX idx_stops_lon_lat_zkey ON stops (lon, lat, zkey, name);")
+    if rtree:
+        conn.execute("CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);")
+        conn.execute("""
+            INSERT INTO stops_rtree (id, min_lon, max_lon, min_lat, max_lat)
+            SELECT id, lon, lon, lat, lat FROM stops WHERE lon IS NOT NULL AND lat IS NOT NULL;
+        """)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def seeded_db(tmp_path):
+    path = str(tmp_path / "stops.db")
+    seed_database(path, synthetic_stops(2000), rtree=True)
+    return path
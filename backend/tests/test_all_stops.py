@@ -0,0 +1,75 @@
+"""/api/allstops keyset cursors."""
+
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.mark.parametrize("name, stop_id", [("Main Street 4", 17), (None, 3), ("Zürich HB", 1), ("", 0), ('quote " and \\', 2**40)])
+def test_cursor_round_trip(name, stop_id):
+    cursor = main.encode_cursor(name, stop_id)
+    assert "=" not in cursor
+    assert main.decode_cursor(cursor) == (name, stop_id)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    main.encode_cursor("Station", 1)[:-3],
+    "WyJTdGF0aW9uIiwgIjEiXQ",  # ["Station", "1"]
+    "WzEsIDFd",  # [1, 1]
+    "WyJTdGF0aW9uIl0",  # ["Station"]
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises((ValueError, TypeError)):
+        main.decode_cursor(cursor)
+
+
+@pytest.fixture
+def client(seeded_db, monkeypatch):
+    monkeypatch.setattr(main, "DATABASE_URL", f"sqlite:///{seeded_db}")
+    with TestClient(main.app) as client:
+        yield client
+        client.portal.call(main.engine.dispose)
+
+
+def expected_order(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT name, bearing, lon, lat FROM stops ORDER BY name, id;").fetchall()
+    conn.close()
+    return [dict(zip(("name", "bearing", "lon", "lat"), row)) for row in rows]
+
+
+@pytest.mark.parametrize("limit", [1, 7, 100, 5000])
+def test_cursor_pages_cover_every_stop_once(client, seeded_db, limit):
+    expected = expected_order(seeded_db)
+    # The NULL names sort first: the walk has to cross from them to the named stops
+    assert expected[0]["name"] is None and expected[-1]["name"] is not None
+
+    stops, cursor = [], None
+    while True:
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/allstops", params=params)
+        assert response.status_code == 200
+        stops += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert stops == expected
+
+
+def test_cursor_matches_offset_pages(client):
+    first = client.get("/api/allstops", params={"limit": 50})
+    cursor = first.headers["X-Next-Cursor"]
+    for offset in range(50, 300, 50):
+        by_cursor = client.get("/api/allstops", params={"limit": 50, "cursor": cursor})
+        by_offset = client.get("/api/allstops", params={"limit": 50, "offset": offset})
+        assert by_cursor.json() == by_offset.json()
+        cursor = by_cursor.headers["X-Next-Cursor"]
+
+
+def test_bad_cursor_is_a_400(client):
+    response = client.get("/api/allstops", params={"cursor": "WzEsIDFd"})
+    assert response.status_code == 400
@@ -0,0 +1,116 @@
+"""The incremental merge (MERGE_MODE=incremental): upsert_stops() on SQLite."""
+
+import asyncio
+import sqlite3
+
+import pytest
+
+import utils.merge as merge
+from utils.spatial_order import zkey
+
+CREATED = "2026-01-01T00:00:00"
+
+
+def stop(stop_id, name, lon, lat, source="uk"):
+    return (name, "N", lon, lat, source, CREATED, zkey(lon, lat), stop_id)
+
+
+async def deliver(*batches):
+    for fetcher, records in batches:
+        yield fetcher, records
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "stops.db")
+    monkeypatch.setattr(merge, "DB_DSN", f"sqlite:///{path}")
+    monkeypatch.setattr(merge, "sqlite_build", None)
+    return path
+
+
+def merge_run(*batches):
+    return asyncio.run(merge.upsert_stops(deliver(*batches)))
+
+
+def stored(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT stop_id, id, name, lon, lat, source FROM stops;").fetchall()
+    conn.close()
+    return {row[0]: row[1:] for row in rows}
+
+
+def first_load(path):
+    merge_run(
+        ("uk", [stop("u1", "Main Street", 1.0, 1.0), stop("u2", "Station", 2.0, 2.0), stop("u3", "Mill Lane", 3.0, 3.0)]),
+        ("hsl", [stop("h1", "Rautatientori", 24.9, 60.1, "hsl"), stop("h2", "Kamppi", 24.93, 60.17, "hsl")]),
+    )
+    return stored(path)
+
+
+def test_first_run_inserts_every_stop(db):
+    before = first_load(db)
+    assert sorted(before) == ["h1", "h2", "u1", "u2", "u3"]
+
+
+def test_diff_inserts_updates_and_deletes(db):
+    before = first_load(db)
+    merge_run(
+        ("uk", [
+            stop("u1", "Main Street", 1.0, 1.0),
+            stop("u2", "Central Station", 2.0, 2.0),
+            stop("u3", "Mill Lane", 3.5, 3.0),
+            stop("u4", "Harbour", 4.0, 4.0),
+        ]),
+        ("hsl", [stop("h1", "Rautatientori", 24.9, 60.1, "hsl")]),
+    )
+    after = stored(db)
+
+    assert after["u1"] == before["u1"]
+    # Renamed and moved stops keep their id
+    assert after["u2"] == (before["u2"][0], "Central Station", 2.0, 2.0, "uk")
+    assert after["u3"] == (before["u3"][0], "Mill Lane", 3.5, 3.0, "uk")
+    assert after["u4"][1:] == ("Harbour", 4.0, 4.0, "uk")
+    assert after["u4"][0] > max(row[0] for row in before.values())
+    # No longer delivered by its source
+    assert "h2" not in after
+
+
+def test_failed_source_keeps_its_stops(db):
+    before = first_load(db)
+    merge_run(
+        ("uk", [stop("u1", "Main Street", 1.0, 1.0)]),
+        # hsl delivered a batch, then failed: its rows are withdrawn
+        ("hsl", [stop("h1", "Renamed mid-fetch", 24.9, 60.1, "hsl")]),
+        ("hsl", None),
+    )
+    after = stored(db)
+
+    assert after["h1"] == before["h1"]
+    assert after["h2"] == before["h2"]
+    assert sorted(after) == ["h1", "h2", "u1"]
+
+
+def test_side_tables_follow_the_diff(db):
+    first_load(db)
+    asyncio.run(merge.save_search_index())
+    asyncio.run(merge.save_rtree())
+    _, synced = merge_run(
+        ("uk", [stop("u1", "Main Street", 1.0, 1.0), stop("u2", "Central Station", 2.0, 2.0), stop("u4", "Harbour", 4.0, 4.0)]),
+    )
+    assert synced == {"stops_search", "stops_rtree"}
+
+    conn = sqlite3.connect(db)
+    ids = {row[0] for row in conn.execute("SELECT id FROM stops;")}
+    assert {row[0] for row in conn.execute("SELECT id FROM stops_rtree;")} == ids
+
+    def search(match):
+        return sorted(row[0] for row in conn.execute(
+            "SELECT stops.stop_id FROM stops_search JOIN stops ON stops.id = stops_search.rowid WHERE stops_search MATCH ?;",
+            (match,),
+        ))
+
+    assert search("central") == ["u2"]
+    assert search("station") == ["u2"]
+    assert search("harbour") == ["u4"]
+    assert search("mill") == []
+    conn.close()
@@ -0,0 +1,94 @@
+"""StopIndex (STOPS_ENGINE=memory) against the SQL bbox query it stands in for."""
+
+import random
+
+import pytest
+from sqlalchemy import create_engine
+
+import main
+from utils.stop_index import DEFAULT_COLUMNS, StopIndex
+
+BOXES = [(0, 10, 0, 10), (4, 6, 4, 6), (5, 5, 5, 5), (2.5, 7.25, 0.5, 3), (11, 12, 11, 12)]
+
+
+@pytest.fixture
+def db(seeded_db):
+    engine = create_engine(f"sqlite:///{seeded_db}")
+    with engine.connect() as conn:
+        yield conn
+    engine.dispose()
+
+
+def load_index(conn) -> StopIndex:
+    queries = main.prepare_queries("lonlat", "sqlite", spatial=True)
+    return StopIndex.from_rows(tuple(row) for row in conn.execute(queries["index_load"]))
+
+
+def sql_bbox(conn, statement, box, limit=10000, offset=0):
+    xmin, xmax, ymin, ymax = box
+    params = {"xmin": xmin, "xmax": xmax, "ymin": ymin, "ymax": ymax, "limit": limit, "offset": offset}
+    return [dict(row._mapping) for row in conn.execute(statement, params)]
+
+
+def random_boxes(count: int, seed: int = 2):
+    rng = random.Random(seed)
+    for _ in range(count):
+        x, y = rng.uniform(-1, 10), rng.uniform(-1, 10)
+        yield (x, x + rng.uniform(0, 6), y, y + rng.uniform(0, 6))
+
+
+@pytest.mark.parametrize("index", [None, "rtree"])
+def test_name_order_matches_sql(db, index):
+    statement = main.prepare_queries("lonlat", "sqlite", index)["bbox"]
+    stop_index = load_index(db)
+    for box in [*BOXES, *random_boxes(50)]:
+        for limit in (0, 1, 7, 10000):
+            assert stop_index.query(*box, limit=limit) == sql_bbox(db, statement, box, limit=limit), (box, limit)
+
+
+def test_null_names_come_first(db):
+    statement = main.prepare_queries("lonlat", "sqlite")["bbox"]
+    expected = sql_bbox(db, statement, BOXES[0])
+    result = load_index(db).query(*BOXES[0])
+    assert result == expected
+    nulls = sum(1 for stop in result if stop["name"] is None)
+    assert nulls > 0
+    assert all(stop["name"] is None for stop in result[:nulls])
+    assert any(stop["bearing"] is None for stop in result)
+
+
+def test_offset_pages_match_sql(db):
+    statement = main.prepare_queries("lonlat", "sqlite")["bbox"]
+    stop_index = load_index(db)
+    for box in BOXES[:3]:
+        full = sql_bbox(db, statement, box)
+        pages = []
+        for offset in range(0, len(full) + 25, 25):
+            page = stop_index.query(*box, limit=25, offset=offset)
+            assert page == sql_bbox(db, statement, box, limit=25, offset=offset)
+            pages += page
+        assert pages == full
+
+
+def test_spatial_order_matches_sql(db):
+    statement = main.prepare_bbox_query("lonlat", None, DEFAULT_COLUMNS, "spatial")
+    stop_index = load_index(db)
+    for box in [*BOXES, *random_boxes(30, seed=3)]:
+        for limit, offset in ((10000, 0), (10, 0), (10, 15)):
+            expected = sql_bbox(db, statement, box, limit=limit, offset=offset)
+            assert stop_index.query(*box, limit=limit, offset=offset, order="spatial") == expected, (box, limit, offset)
+
+
+def test_snapshot_round_trip(db, tmp_path):
+    stop_index = load_index(db)
+    path = str(tmp_path / "stops.idx")
+    stop_index.save(path, generation="7")
+
+    snapshot = StopIndex.open(path)
+    assert snapshot.generation == "7"
+    assert len(snapshot) == len(stop_index)
+    columns = ("name", "bearing", "lon", "lat", "source")
+    for box in [*BOXES, *random_boxes(20, seed=4)]:
+        for order in ("name", "spatial"):
+            expected = stop_index.query(*box, limit=50, offset=3, columns=columns, order=order)
+            assert snapshot.query(*box, limit=50, offset=3, columns=columns, order=order) == expected
@@ -0,0 +1,71 @@
+"""
+Per-zoom cluster pyramid for zoomed-out map views.
+
+The world is cut into a square lon/lat grid per zoom level, CELLS_PER_TILE
+cells across the width of one slippy-map tile, so a viewport at zoom z always
+covers roughly the same number of cells. merge.py aggregates the stops once at
+MAX_ZOOM (in SQL) and rolls the cells up to every coarser zoom here; the API
+then reads clusters for a bbox with a primary-key range scan.
+"""
+
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+MAX_ZOOM = 10
+CELL_BITS = 3  # 2**3 = 8 cells across one tile
+CELLS_PER_TILE = 2 ** CELL_BITS
+
+
+def cell_size(zoom: int) -> float:
+    """Width (and height) of one cluster cell in degrees."""
+    return 360.0 / (2 ** (zoom + CELL_BITS))
+
+
+def cell_range(xmin: float, xmax: float, ymin: float, ymax: float, zoom: int) -> Tuple[int, int, int, int]:
+    """Return (cx0, cx1, cy0, cy1) of the cells overlapping a bbox."""
+    size = cell_size(zoom)
+    return (
+        int((max(xmin, -180.0) + 180.0) // size),
+        int((min(xmax, 180.0) + 180.0) // size),
+        int((max(ymin, -90.0) + 90.0) // size),
+        int((min(ymax, 90.0) + 90.0) // size),
+    )
+
+
+def add_cells(level: Dict[Tuple[int, int], List[Any]], cells: Iterable[Tuple[int, int, Any, int, float, float]]):
+    """
+    Accumulate a batch of MAX_ZOOM cells into `level`, which starts as {}.
+
+    cells are (cx, cy, source, count, sum_lon, sum_lat) rows grouped by cell and
+    source at MAX_ZOOM, so they can be read from the database in batches.
+    """
+    for cx, cy, source, count, sum_lon, sum_lat in cells:
+        acc = level.setdefault((cx, cy), [0, 0.0, 0.0, {}])
+        acc[0] += count
+        acc[1] += sum_lon
+        acc[2] += sum_lat
+        acc[3][source] = acc[3].get(source, 0) + count
+
+
+def roll_up(level: Dict[Tuple[int, int], List[Any]]) -> Iterator[Tuple[Any, ...]]:
+    """
+    Roll the MAX_ZOOM cells in `level` up to every zoom level. Yields
+    (zoom, cx, cy, lon, lat, count, source) rows with the centroid, total count
+    and dominant source of every non-empty cell, one zoom at a time.
+    """
+    for zoom in range(MAX_ZOOM, -1, -1):
+        for (cx, cy), (count, sum_lon, sum_lat, sources) in level.items():
+            dominant = max(sources.items(), key=lambda item: (item[1], item[0] or ""))[0]
+            yield (zoom, cx, cy, sum_lon / count, sum_lat / count, count, dominant)
+
+        if zoom == 0:
+            break
+        parent: Dict[Tuple[int, int], List[Any]] = {}
+        for (cx, cy), (count, sum_lon, sum_lat, sources) in level.items():
+            acc = parent.setdefault((cx >> 1, cy >> 1), [0, 0.0, 0.0, {}])
+            acc[0] += count
+            acc[1] += sum_lon
+            acc[2] += sum_lat
+            for source, n in sources.items():
+                acc[3][source] = acc[3].get(source, 0) + n
+        level = parent
+
@@ -1,7 +1,14 @@
 import os
+import sys
+from pathlib import Path
+
 import sqlalchemy
 from sqlalchemy import text
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from utils import sqlite_files
+
 # Database URL
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -10,10 +17,15 @@ def create_indexes():
         print("⚠️ DATABASE_URL not set.")
         return
 
+    url = DATABASE_URL
+    if url.startswith("sqlite:"):
+        # The database utils/merge.py published last
+        url = f"sqlite:///{sqlite_files.live_path(sqlite_files.database_path(url))}"
+
     try:
-        print(f"Connecting to {DATABASE_URL}...")
+        print(f"Connecting to {url}...")
         # Use AUTOCOMMIT to allow certain schema changes and to avoid transaction wrapping.
-        engine = sqlalchemy.create_engine(DATABASE_URL).execution_options(isolation_level="AUTOCOMMIT")
+        engine = sqlalchemy.create_engine(url).execution_options(isolation_level="AUTOCOMMIT")
 
         with engine.connect() as conn:
             # 1. Check schema (use PRAGMA for sqlite and information_schema for others)
@@ -43,6 +55,16 @@ def create_indexes():
             except Exception as e:
                 print(f"⚠️ Failed to create name index: {e}")
 
+            # Postgres needs (name, id) spelled out for keyset pagination;
+            # in SQLite the name index already ends with the rowid (= id).
+            if engine.dialect.name != "sqlite":
+                print("Creating index on '(name, id)'...")
+                try:
+                    conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stops_name_id ON stops (name, id);"))
+                    print("✅ Index 'idx_stops_name_id' created.")
+                except Exception as e:
+                    print(f"⚠️ Failed to create name/id index: {e}")
+
             # 3. Create Location Indexes (used for bounding box)
             if "lon" in cols and "lat" in cols:
                 print("Detected 'lon' and 'lat' columns. Creating composite index...")
@@ -54,6 +76,35 @@ def create_indexes():
                     print("✅ Index 'idx_stops_lon_lat' created.")
                 except Exception as e:
                     print(f"⚠️ Failed to create lon/lat index: {e}")
+                if "zkey" in cols:
+                    print("Detected 'zkey' column. Creating spatial order index...")
+                    try:
+                        if engine.dialect.name == "sqlite":
+                            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_stops_lon_lat_zkey ON stops (lon, lat, zkey, name);"))
+                        else:
+                            conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stops_lon_lat_zkey ON stops (lon, lat, zkey, name);"))
+                        print("✅ Index 'idx_stops_lon_lat_zkey' created.")
+                    except Exception as e:
+                        print(f"⚠️ Failed to create spatial order index: {e}")
+                if engine.dialect.name == "sqlite":
+                    print("Creating R*Tree 'stops_rtree'...")
+                    try:
+                        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS stops_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);"))
+                        conn.execute(text("DELETE FROM stops_rtree;"))
+                        conn.execute(text("""
+                            INSERT INTO stops_rtree (id, min_lon, max_lon, min_lat, max_lat)
+                            SELECT id, lon, lon, lat, lat FROM stops WHERE lon IS NOT NULL AND lat IS NOT NULL;
+                        """))
+                        print("✅ R*Tree 'stops_rtree' created.")
+                    except Exception as e:
+                        print(f"⚠️ Failed to create R*Tree: {e}")
+                if "geom" in cols and engine.dialect.name != "sqlite":
+                    print("Detected PostGIS 'geom' column. Creating GiST index...")
+                    try:
+                        conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_stops_geom ON stops USING GIST (geom);"))
+                        print("✅ Index 'idx_stops_geom' created.")
+                    except Exception as e:
+                        print(f"⚠️ Failed to create GiST index: {e}")
             elif "location" in cols:
                 print("Detected 'location' array column. Creating functional indexes (Postgres only)...")
                 if engine.dialect.name != "sqlite":
@@ -16,6 +16,10 @@ import httpx
 
 print("[merge.py] aiosqlite and httpx imports done", flush=True)
 
+from utils import sqlite_files
+from utils.merge import bump_generation, read_search_fold, rebuild_sqlite_clusters
+from utils.search import FOLD_VERSION, fold_name
+
 import sys
 
 SINGLE_SOURCE = None
@@ -35,18 +39,44 @@ async def main():
             print("[merge.py] DATABASE_URL not set. Exiting.", flush=True)
             return
 
-        db_path = DATABASE_URL
-        if DATABASE_URL.startswith("sqlite:///"):
-            db_path = DATABASE_URL.split("sqlite:///", 1)[1]
+        # The file the API reads: a blue/green merge may have published another build
+        db_path = sqlite_files.live_path(sqlite_files.database_path(DATABASE_URL))
 
         conn = await aiosqlite.connect(db_path)
+        await conn.create_function("fold_name", 1, fold_name, deterministic=True)
         try:
-            await conn.execute("DELETE FROM stops WHERE source = ?", (source,))
+            cursor = await conn.execute(
+                "SELECT name FROM sqlite_master WHERE name IN ('stops_search', 'stops_rtree', 'stop_clusters', 'source_stats');"
+            )
+            tables = {name for (name,) in await cursor.fetchall()}
+            if "stops_search" in tables and await read_search_fold(conn) != FOLD_VERSION:
+                # Folded by an older fold_name(): the next merge rebuilds it anyway
+                tables.discard("stops_search")
+
+            # The side tables go with the stops, in one transaction
+            await conn.execute("BEGIN IMMEDIATE")
+            if "stops_search" in tables:
+                # Contentless FTS5 rows are deleted by repeating the indexed text
+                await conn.execute("""
+                    INSERT INTO stops_search (stops_search, rowid, name_folded)
+                    SELECT 'delete', id, fold_name(name) FROM stops WHERE source = ?;
+                """, (source,))
+            if "stops_rtree" in tables:
+                await conn.execute("DELETE FROM stops_rtree WHERE id IN (SELECT id FROM stops WHERE source = ?);", (source,))
+            cursor = await conn.execute("DELETE FROM stops WHERE source = ?", (source,))
+            removed = cursor.rowcount
+            if "source_stats" in tables:
+                await conn.execute("DELETE FROM source_stats WHERE source = ?", (source,))
+            if "stop_clusters" in tables:
+                await rebuild_sqlite_clusters(conn)
             await conn.commit()
-            print(f"[merge.py] remove_source_data: Removed records for source {source}", flush=True)
+            print(f"[merge.py] remove_source_data: Removed {removed} records for source {source}", flush=True)
         finally:
             await conn.close()
 
+        # Roll the API's caches, ETags and memory index over to the new data
+        await bump_generation()
+
     if SINGLE_SOURCE:
         await remove_source_data(SINGLE_SOURCE)
     else:
@@ -4,9 +4,14 @@ print("[merge.py] Module loading started...", flush=True)
 import os
 import json
 import asyncio
+import contextvars
 import datetime
+import itertools
+import re
+import struct
+import time
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Iterable, Iterator, Optional, Tuple
 import logging
 
 print("[merge.py] Standard library imports done", flush=True)
@@ -36,48 +41,97 @@ debug = False
 # Add project root to import path (so "sources.*" imports work)
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
+from utils.clusters import MAX_ZOOM as CLUSTER_MAX_ZOOM, add_cells, cell_size, roll_up
+from utils.search import FOLD_VERSION, fold_name
+from utils.spatial_order import zkey
+from utils.stop_index import StopIndex, DEFAULT_CELL_SIZE
+from utils import sqlite_files
+
 # --- CONFIG ---
 print("[merge.py] Config section starting...", flush=True)
 DATA_DIR = Path("data")
 # Use environment DATABASE_URL if present, otherwise fallback to a common docker-compose name
 DB_DSN = os.getenv("DATABASE_URL", "sqlite:///./stops.db")
+# POSTGIS=auto fills a geometry(Point, 4326) column with a GiST index on
+# Postgres when the postgis extension can be enabled; off keeps lon/lat only.
+POSTGIS = os.getenv("POSTGIS", "auto").lower()
+# STOPS_SNAPSHOT: also write the API's memory index (STOPS_ENGINE=memory) to
+# this file, for the API workers to map instead of each loading the stops.
+STOPS_SNAPSHOT = os.getenv("STOPS_SNAPSHOT", "")
+STOPS_INDEX_CELL_SIZE = float(os.getenv("STOPS_INDEX_CELL_SIZE", str(DEFAULT_CELL_SIZE)))
+# MERGE_MODE=incremental (default) diffs the fetched stops against the
+# stored ones by (source, stop_id) and writes only the difference, in one
+# transaction. MERGE_MODE=rebuild reloads everything on full runs: into a
+# staging table swapped in on Postgres, into a new database file published
+# on SQLite (utils/sqlite_files.py). Single-source runs are always incremental.
+MERGE_MODE = os.getenv("MERGE_MODE", "incremental").lower()
+# Streaming merge: fetched stops go to the database in batches of
+# MERGE_BATCH_ROWS, through a queue of at most MERGE_QUEUE_BATCHES batches
+# (fetchers wait while it is full), with at most MERGE_FETCH_CONCURRENCY
+# sources downloading at once (0 = all). Together they bound the merge's memory.
+MERGE_BATCH_ROWS = int(os.getenv("MERGE_BATCH_ROWS", "5000"))
+MERGE_QUEUE_BATCHES = int(os.getenv("MERGE_QUEUE_BATCHES", "8"))
+MERGE_FETCH_CONCURRENCY = int(os.getenv("MERGE_FETCH_CONCURRENCY", "4"))
+# How long the Postgres table swap may wait for readers before it backs off
+# and retries, rather than queueing the API behind it.
+MERGE_SWAP_LOCK_TIMEOUT_MS = int(os.getenv("MERGE_SWAP_LOCK_TIMEOUT_MS", "2000"))
+MERGE_SWAP_ATTEMPTS = int(os.getenv("MERGE_SWAP_ATTEMPTS", "5"))
 print(f"[merge.py] DB_DSN={DB_DSN}", flush=True)
 print("[merge.py] Module load complete", flush=True)
 
 
-async def ensure_dir(path: Path):
-    print(f"[merge.py] ensure_dir: {path}", flush=True)
-    path.mkdir(parents=True, exist_ok=True)
+class SourceDump:
+    """
+    Raw source data, saved to data/{source}/{source}-{date}.json one batch at
+    a time. The file is written under a .partial name and only renamed into
+    place by finish(), so a failed fetch never replaces the last good dump.
+    """
 
+    def __init__(self, source: str):
+        date = datetime.date.today().strftime("%Y%m%d")
+        self.path = DATA_DIR / source / f"{source}-{date}.json"
+        self.partial = self.path.with_name(self.path.name + ".partial")
+        self.count = 0
+        self.file = None
 
-def save_json_sync(path: Path, data: Any):
-    """Synchronous JSON save used by asyncio.to_thread"""
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    def _write(self, batch: List[Dict[str, Any]]):
+        if self.file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.partial, "w", encoding="utf-8")
+            self.file.write("[")
+        for item in batch:
+            self.file.write(",\n" if self.count else "\n")
+            self.file.write(json.dumps(item, default=str))
+            self.count += 1
 
+    def _finish(self):
+        if self.file is None:
+            self._write([])
+        self.file.write("\n]\n")
+        self.file.close()
+        os.replace(self.partial, self.path)
 
-async def save_json(path: Path, data: Any):
-    """Offload JSON file writing to a thread"""
-    print(f"[merge.py] save_json: {path}", flush=True)
-    await asyncio.to_thread(save_json_sync, path, data)
+    def _discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.partial.unlink(missing_ok=True)
 
+    # Offload file writing to a thread, to avoid blocking the event loop
+    async def write(self, batch: List[Dict[str, Any]]):
+        await asyncio.to_thread(self._write, batch)
 
-async def dump_source_data(source: str, data: List[Dict[str, Any]]):
-    """Save raw source data to data/{source}/{source}-{date}.json"""
-    print(f"[merge.py] dump_source_data: source={source}, len={len(data)}", flush=True)
-    date = datetime.date.today().strftime("%Y%m%d")
-    dir_path = DATA_DIR / source
-    await ensure_dir(dir_path)
-    file_path = dir_path / f"{source}-{date}.json"
-    # use threaded write to avoid blocking event loop
-    await save_json(file_path, data)
-    print(f"✅ Saved {len(data)} stops for {source} → {file_path}", flush=True)
+    async def finish(self):
+        await asyncio.to_thread(self._finish)
+        print(f"✅ Saved {self.count} stops → {self.path}", flush=True)
+
+    async def discard(self):
+        await asyncio.to_thread(self._discard)
 
 
 def normalize_for_db(stop: Dict[str, Any]) -> Dict[str, Any]:
     """
     Reduce to minimal required schema:
-    {"bearing": "", "name": "stop name", "location": [lon, lat], "source": "...", "created_at": datetime}
+    {"bearing": "", "name": "stop name", "location": [lon, lat], "source": "...", "created_at": datetime, "stop_id": "..."}
     """
     lon = None
     lat = None
@@ -112,23 +166,235 @@ def normalize_for_db(stop: Dict[str, Any]) -> Dict[str, Any]:
         "location": [lon, lat],
         "source": stop.get("source", "") or "",
         "created_at": created_at,
+        # The source's own stable id, which keys incremental merges
+        "stop_id": str(stop["id"]) if stop.get("id") is not None else None,
     }
 
 
+def stop_record(stop: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """
+    The stops row for a fetched stop: (name, bearing, lon, lat, source,
+    created_at, zkey, stop_id), or None when it has no coordinates.
+    """
+    norm = normalize_for_db(stop)
+    lon, lat = norm["location"]
+    if lon is None or lat is None:
+        return None
+    return (
+        norm["name"], norm["bearing"], lon, lat, norm["source"],
+        norm["created_at"].isoformat(), zkey(lon, lat), norm["stop_id"],
+    )
+
+
 def _is_postgres(dsn: str) -> bool:
     return dsn.startswith("postgresql://") or dsn.startswith("postgres://")
 
 
-async def save_to_db(stops: List[Dict[str, Any]], source_only: str = None):
-    print(f"[merge.py] save_to_db: source_only={source_only}", flush=True)
-    """Insert merged stops into database (SQLite/Postgres compatible)"""
-    print(f"[merge.py] save_to_db: connecting to {DB_DSN}", flush=True)
+# The database file a blue/green SQLite run is building, set by begin_sqlite_build()
+sqlite_build = None
+
+
+def sqlite_path() -> str:
+    """The SQLite file the merge writes: the build in progress, or the live database."""
+    return sqlite_build or sqlite_files.live_path(sqlite_files.database_path(DB_DSN))
+
+
+async def sqlite_connect():
+    """Connect to sqlite_path(). Nobody reads a build yet, so it is written without journal or fsync."""
+    conn = await aiosqlite.connect(sqlite_path())
+    if sqlite_build:
+        await conn.execute("PRAGMA journal_mode = OFF;")
+        await conn.execute("PRAGMA synchronous = OFF;")
+        await conn.execute("PRAGMA cache_size = -262144;")
+        await conn.execute("PRAGMA temp_store = MEMORY;")
+    return conn
+
+
+async def read_sqlite_generation(path: str) -> str:
+    """The data generation stored in an SQLite database ("0" if there is none)."""
+    if not os.path.exists(path):
+        return "0"
+    conn = await aiosqlite.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = await conn.execute("SELECT value FROM stops_meta WHERE key = 'generation';")
+        row = await cursor.fetchone()
+    except aiosqlite.OperationalError:
+        # stops_meta does not exist until the first merge
+        row = None
+    await conn.close()
+    return row[0] if row else "0"
+
+
+async def begin_sqlite_build():
+    """
+    Start a blue/green SQLite run: create the file of the next generation
+    (stops-<n>.db), carrying stops_meta over, and direct every later step
+    at it. publish_sqlite_build() puts it live once the merge is done.
+    """
+    global sqlite_build
+    if _is_postgres(DB_DSN) or SINGLE_SOURCE or MERGE_MODE != "rebuild":
+        return
+
+    db_path = sqlite_files.database_path(DB_DSN)
+    generation = await read_sqlite_generation(sqlite_files.live_path(db_path))
+    build = sqlite_files.build_path(db_path, str(int(generation) + 1))
+    # Left over from a merge that failed before publishing
+    sqlite_files.remove_database(build)
+    conn = await aiosqlite.connect(build)
+    await conn.execute("CREATE TABLE stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+    await conn.execute("INSERT INTO stops_meta (key, value) VALUES ('generation', ?);", (generation,))
+    await conn.commit()
+    await conn.close()
+    sqlite_build = build
+    print(f"[merge.py] Building new database {build}", flush=True)
+
+
+async def publish_sqlite_build():
+    """
+    Finish the blue/green build: add the indexes the live stops table has,
+    ANALYZE and VACUUM it, switch it to WAL for the API's readers, then
+    point the pointer file at it and remove builds older than the last one.
+    """
+    global sqlite_build
+    if not sqlite_build:
+        return
+
+    started = time.perf_counter()
+    db_path = sqlite_files.database_path(DB_DSN)
+    live = sqlite_files.live_path(db_path)
+    definitions = []
+    if os.path.exists(live):
+        source = await aiosqlite.connect(f"file:{live}?mode=ro", uri=True)
+        cursor = await source.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'stops' AND sql IS NOT NULL;")
+        definitions = await cursor.fetchall()
+        await source.close()
+
+    conn = await sqlite_connect()
+    cursor = await conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")
+    existing = {name for (name,) in await cursor.fetchall()}
+    definitions = [definition for name, definition in definitions if name not in existing]
+    for definition in definitions:
+        await conn.execute(definition)
+    await conn.execute("ANALYZE;")
+    await conn.commit()
+    await conn.execute("VACUUM;")
+    await conn.execute("PRAGMA journal_mode = WAL;")
+    await conn.close()
+
+    build, sqlite_build = sqlite_build, None
+    sqlite_files.publish(db_path, build)
+    sqlite_files.remove_old_builds(db_path, keep=(build, live))
+    print(f"🔀 Published {build} ({len(definitions)} indexes copied, finished in {time.perf_counter() - started:.1f}s)", flush=True)
+
+
+async def ensure_postgis(conn) -> bool:
+    """
+    Enable PostGIS and add stops.geom plus its GiST index. Returns False, and
+    the merge carries on with plain lon/lat, when the extension is missing.
+    With POSTGIS=off a geom column left from an earlier run stays on the live
+    table (dropping it would lock out the API); the merge stops filling it.
+    """
+    if POSTGIS == "off":
+        return False
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+    except Exception as e:
+        print(f"⚠️ PostGIS not available, storing lon/lat only: {e}", flush=True)
+        return False
+    await conn.execute("ALTER TABLE stops ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326);")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_stops_geom ON stops USING GIST (geom);")
+    print("Ensured PostGIS geom column and GiST index", flush=True)
+    return True
+
+
+async def save_geom_complete(conn, complete: bool):
+    """
+    Record in stops_meta whether every stop with a location has stops.geom
+    filled. The API only filters on geom when this says "1", whatever its
+    own POSTGIS setting; call it in the transaction that publishes the rows.
+    """
+    await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+    await conn.execute("""
+        INSERT INTO stops_meta (key, value) VALUES ('geom_complete', $1)
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+    """, "1" if complete else "0")
+
+
+# Stops are matched across runs by the source's own id
+STOP_ID_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS idx_stops_source_stop_id ON stops (source, stop_id);"
+# The stops columns of a stop_record() row, in order
+RECORD_COLUMNS = ["name", "bearing", "lon", "lat", "source", "created_at", "zkey", "stop_id"]
 
+
+async def copy_records(conn, table: str, columns: List[str], records: List[Tuple[Any, ...]]) -> float:
+    """
+    Load one batch into a Postgres table with binary COPY, several times
+    faster than an INSERT per row. Returns the seconds it took.
+    """
+    started = time.perf_counter()
+    await conn.copy_records_to_table(table, records=records, columns=columns)
+    return time.perf_counter() - started
+
+
+# Little-endian EWKB Point with an SRID: byte order, type | SRID flag, SRID, x, y
+EWKB_POINT = struct.Struct("<BIIdd")
+
+
+def ewkb_point(point: Tuple[float, float]) -> bytes:
+    """A (lon, lat) pair as a WGS 84 EWKB point, the binary input of geometry."""
+    lon, lat = point
+    return EWKB_POINT.pack(1, 0x20000001, 4326, lon, lat)
+
+
+async def set_geometry_codec(conn):
+    """Let binary COPY fill a geometry column from (lon, lat) pairs on `conn`."""
+    schema = await conn.fetchval("SELECT typnamespace::regnamespace::text FROM pg_type WHERE typname = 'geometry';")
+    await conn.set_type_codec("geometry", schema=schema, encoder=ewkb_point, decoder=bytes, format="binary")
+
+
+def load_rate(rows: int, seconds: float) -> str:
+    return f"{rows} rows in {seconds:.1f}s of COPY ({rows / seconds if seconds else 0:,.0f} rows/s)"
+
+
+# Rows per round trip when the merge reads or writes a whole table
+SEARCH_BATCH_ROWS = 50000
+
+
+async def read_batches(conn, query: str, *args) -> AsyncIterator[list]:
+    """
+    Rows of `query` in lists of SEARCH_BATCH_ROWS, read through a cursor
+    rather than all at once. On Postgres `conn` must be in a transaction.
+    """
     if _is_postgres(DB_DSN):
-        conn = await asyncpg.connect(DB_DSN)
-        print(f"[merge.py] Connected to DB (postgresql)", flush=True)
+        cursor = await conn.cursor(query, *args)
+        while True:
+            rows = await cursor.fetch(SEARCH_BATCH_ROWS)
+            if not rows:
+                break
+            yield rows
+    else:
+        cursor = await conn.execute(query, args)
+        while True:
+            rows = await cursor.fetchmany(SEARCH_BATCH_ROWS)
+            if not rows:
+                break
+            yield rows
+
+
+def batched(rows: Iterable[Tuple[Any, ...]]) -> Iterator[List[Tuple[Any, ...]]]:
+    """Split `rows` into lists of SEARCH_BATCH_ROWS, for writing without building one big list."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, SEARCH_BATCH_ROWS))
+        if not batch:
+            break
+        yield batch
+
 
-        print(f"[merge.py] Creating stops table if needed...", flush=True)
+async def ensure_stops_table(conn):
+    """Create the stops table, or add the columns older merges didn't write."""
+    print(f"[merge.py] Creating stops table if needed...", flush=True)
+    if _is_postgres(DB_DSN):
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS stops (
                 id SERIAL PRIMARY KEY,
@@ -137,48 +403,14 @@ async def save_to_db(stops: List[Dict[str, Any]], source_only: str = None):
                 lon DOUBLE PRECISION,
                 lat DOUBLE PRECISION,
                 source TEXT,
-                created_at TEXT
+                created_at TEXT,
+                zkey BIGINT,
+                stop_id TEXT
             );
         """)
-        print("Ensured stops table exists", flush=True)
-
-        if source_only:
-            print(f"[merge.py] Deleting existing stops from source '{source_only}'...", flush=True)
-            await conn.execute("DELETE FROM stops WHERE source = $1;", source_only)
-            print(f"Deleted existing stops from source '{source_only}'", flush=True)
-        else:
-            print(f"[merge.py] Deleting all rows from stops table...", flush=True)
-            await conn.execute("DELETE FROM stops;")
-            print("Cleared stops table", flush=True)
-
-        records = []
-        for s in stops:
-            loc = s.get("location") or [None, None]
-            lon = float(loc[0]) if loc[0] is not None else None
-            lat = float(loc[1]) if loc[1] is not None else None
-            created = s.get("created_at")
-            if isinstance(created, datetime.datetime):
-                created = created.isoformat()
-            records.append((s.get("name"), s.get("bearing"), lon, lat, s.get("source"), created))
-
-        print(f"[merge.py] Inserting {len(records)} stops...", flush=True)
-        await conn.executemany(
-            "INSERT INTO stops (name, bearing, lon, lat, source, created_at) VALUES ($1, $2, $3, $4, $5, $6);",
-            records,
-        )
-        await conn.close()
-        print(f"💾 Inserted {len(records)} merged stops into database.", flush=True)
-
+        await conn.execute("ALTER TABLE stops ADD COLUMN IF NOT EXISTS zkey BIGINT;")
+        await conn.execute("ALTER TABLE stops ADD COLUMN IF NOT EXISTS stop_id TEXT;")
     else:
-        # SQLite path
-        db_path = DB_DSN
-        if DB_DSN.startswith("sqlite:///"):
-            db_path = DB_DSN.split("sqlite:///", 1)[1]
-        conn = await aiosqlite.connect(db_path)
-        conn.row_factory = aiosqlite.Row
-        print(f"[merge.py] Connected to DB (sqlite path={db_path})", flush=True)
-
-        print(f"[merge.py] Creating stops table if needed...", flush=True)
         await conn.execute("""
             CREATE TABLE IF NOT EXISTS stops (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -187,44 +419,955 @@ async def save_to_db(stops: List[Dict[str, Any]], source_only: str = None):
                 lon REAL,
                 lat REAL,
                 source TEXT,
-                created_at TEXT
+                created_at TEXT,
+                zkey INTEGER,
+                stop_id TEXT
             );
         """)
-        print("Ensured stops table exists", flush=True)
+        cursor = await conn.execute("PRAGMA table_info('stops');")
+        columns = [row[1] for row in await cursor.fetchall()]
+        if "zkey" not in columns:
+            await conn.execute("ALTER TABLE stops ADD COLUMN zkey INTEGER;")
+        if "stop_id" not in columns:
+            await conn.execute("ALTER TABLE stops ADD COLUMN stop_id TEXT;")
+    print("Ensured stops table exists", flush=True)
 
-        if source_only:
-            print(f"[merge.py] Deleting existing stops from source '{source_only}'...", flush=True)
-            await conn.execute("DELETE FROM stops WHERE source = ?;", (source_only,))
-            print(f"Deleted existing stops from source '{source_only}'", flush=True)
-        else:
-            print(f"[merge.py] Deleting all rows from stops table...", flush=True)
-            await conn.execute("DELETE FROM stops;")
-            print("Cleared stops table", flush=True)
-
-        records = []
-        for s in stops:
-            loc = s.get("location") or [None, None]
-            lon = float(loc[0]) if loc[0] is not None else None
-            lat = float(loc[1]) if loc[1] is not None else None
-            created = s.get("created_at")
-            if isinstance(created, datetime.datetime):
-                created = created.isoformat()
-            records.append((s.get("name"), s.get("bearing"), lon, lat, s.get("source"), created))
-
-        print(f"[merge.py] Inserting {len(records)} stops...", flush=True)
+
+async def save_to_db(batches: AsyncIterator[Tuple[str, Optional[List[Tuple[Any, ...]]]]], source_only: str = None) -> Tuple[str, set]:
+    """
+    Store stops in the database (SQLite/Postgres compatible) as the
+    fetchers deliver them. `batches` yields (fetcher, records) pairs of
+    stop_record() rows; records is None when that fetcher failed part way,
+    and the rows it already delivered are dropped again.
+
+    Returns the table loaded (stops, or stops_staging for a rebuild on
+    Postgres, which swap_staging() then publishes) and the side tables
+    (stops_search, stops_rtree) already brought up to date with it.
+    """
+    print(f"[merge.py] save_to_db: source_only={source_only} mode={MERGE_MODE}", flush=True)
+    if MERGE_MODE == "rebuild" and not source_only:
+        return await reload_stops(batches), set()
+    return await upsert_stops(batches)
+
+
+async def reload_stops(batches) -> str:
+    """
+    MERGE_MODE=rebuild: insert every stop into a fresh copy of the table,
+    stops_staging on Postgres or the blue/green build on SQLite.
+    Returns the table loaded.
+    """
+    print(f"[merge.py] save_to_db: connecting to {DB_DSN}", flush=True)
+    # Rows inserted per fetcher and the stop sources they carry, to undo a failed fetch
+    counts: Dict[str, int] = {}
+    stop_sources: Dict[str, set] = {}
+
+    if _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        print(f"[merge.py] Connected to DB (postgresql)", flush=True)
+        await ensure_stops_table(conn)
+        postgis = await ensure_postgis(conn)
+
+        # Loaded out of the API's sight; swap_staging() publishes it
+        table = "stops" + STAGING_SUFFIX
+        await conn.execute(f"DROP TABLE IF EXISTS {table};")
+        await conn.execute(f"CREATE TABLE {table} (LIKE stops INCLUDING DEFAULTS);")
+        if not postgis:
+            # A leftover geom column leaves with the swap, without touching stops
+            await conn.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS geom;")
+        print(f"[merge.py] Loading into {table}...", flush=True)
+        copy_seconds = 0.0
+        columns = RECORD_COLUMNS
+        if postgis:
+            # COPY takes values, not expressions: send geom as EWKB with the
+            # row rather than UPDATE every row (and double the table) after
+            await set_geometry_codec(conn)
+            columns = [*RECORD_COLUMNS, "geom"]
+
+        async with conn.transaction():
+            async for fetcher, records in batches:
+                if records is None:
+                    if counts.pop(fetcher, 0):
+                        await conn.execute(
+                            f"DELETE FROM {table} WHERE source = ANY($1::text[]);",
+                            list(stop_sources.pop(fetcher)),
+                        )
+                    continue
+                rows = records
+                if postgis:
+                    rows = [(*r, (r[2], r[3]) if r[2] is not None and r[3] is not None else None) for r in records]
+                copy_seconds += await copy_records(conn, table, columns, rows)
+                counts[fetcher] = counts.get(fetcher, 0) + len(records)
+                stop_sources.setdefault(fetcher, set()).update(r[4] for r in records)
+            print(f"📥 Loaded {load_rate(sum(counts.values()), copy_seconds)}.", flush=True)
+            # A stop delivered twice (two fetchers of one feed) keeps its last copy
+            await conn.execute(f"""
+                DELETE FROM {table} a USING {table} b
+                WHERE a.source = b.source AND a.stop_id = b.stop_id AND a.id < b.id;
+            """)
+
+        await index_staging(conn, postgis)
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        print(f"[merge.py] Connected to DB (sqlite path={sqlite_path()})", flush=True)
+        await ensure_stops_table(conn)
+        table = "stops"
+
+        async for fetcher, records in batches:
+            if records is None:
+                if counts.pop(fetcher, 0):
+                    dropped = list(stop_sources.pop(fetcher))
+                    await conn.execute(f"DELETE FROM stops WHERE source IN ({', '.join('?' * len(dropped))});", dropped)
+                continue
+            await conn.executemany(
+                "INSERT INTO stops (name, bearing, lon, lat, source, created_at, zkey, stop_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                records,
+            )
+            counts[fetcher] = counts.get(fetcher, 0) + len(records)
+            stop_sources.setdefault(fetcher, set()).update(r[4] for r in records)
+        await conn.execute("""
+            DELETE FROM stops WHERE stop_id IS NOT NULL AND id NOT IN (
+                SELECT MAX(id) FROM stops WHERE stop_id IS NOT NULL GROUP BY source, stop_id
+            );
+        """)
+        await conn.execute(STOP_ID_INDEX)
+        await conn.commit()
+        await conn.close()
+
+    print(f"💾 Inserted {sum(counts.values())} merged stops into database.", flush=True)
+    return table
+
+
+# Stored stops of the sources this run fetched that it didn't fetch again
+# (stops without a stop_id are always replaced)
+GONE_STOPS = """
+    stops.source IN (SELECT source FROM stops_incoming)
+    AND (stops.stop_id IS NULL OR NOT EXISTS (
+        SELECT 1 FROM stops_incoming i WHERE i.source = stops.source AND i.stop_id = stops.stop_id
+    ))
+"""
+# Fetched stops not stored yet
+NEW_STOPS = """
+    i.stop_id IS NULL OR NOT EXISTS (
+        SELECT 1 FROM stops WHERE stops.source = i.source AND stops.stop_id = i.stop_id
+    )
+"""
+
+
+async def upsert_stops(batches) -> Tuple[str, set]:
+    """
+    MERGE_MODE=incremental: collect the fetched stops in a temporary
+    stops_incoming table, then, in one transaction, delete the stored stops
+    of the fetched sources that are gone, update the ones whose name,
+    bearing or position changed, and insert the new ones. Unchanged rows
+    keep their id and created_at and aren't written at all. Sources whose
+    fetch failed keep their stored stops. stops_search and stops_rtree, if
+    they exist, are updated for the changed rows in the same transaction.
+    """
+    print(f"[merge.py] save_to_db: connecting to {DB_DSN}", flush=True)
+    started = time.perf_counter()
+
+    if _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        print(f"[merge.py] Connected to DB (postgresql)", flush=True)
+        await ensure_stops_table(conn)
+        await conn.execute(STOP_ID_INDEX)
+        postgis = await ensure_postgis(conn)
+        await conn.execute("""
+            CREATE TEMP TABLE stops_incoming (
+                seq BIGSERIAL, fetcher TEXT, name TEXT, bearing TEXT, lon DOUBLE PRECISION,
+                lat DOUBLE PRECISION, source TEXT, created_at TEXT, zkey BIGINT, stop_id TEXT
+            );
+        """)
+        copy_seconds = 0.0
+        copied = 0
+        async for fetcher, records in batches:
+            if records is None:
+                await conn.execute("DELETE FROM stops_incoming WHERE fetcher = $1;", fetcher)
+                continue
+            copy_seconds += await copy_records(
+                conn, "stops_incoming", ["fetcher", *RECORD_COLUMNS], [(fetcher, *r) for r in records],
+            )
+            copied += len(records)
+        print(f"📥 Loaded {load_rate(copied, copy_seconds)}.", flush=True)
+        await conn.execute("CREATE INDEX ON stops_incoming (source, stop_id);")
+        # A stop delivered twice (two fetchers of one feed) keeps its last copy
+        await conn.execute("""
+            DELETE FROM stops_incoming a USING stops_incoming b
+            WHERE a.source = b.source AND a.stop_id = b.stop_id AND a.seq < b.seq;
+        """)
+        await conn.execute("ANALYZE stops_incoming;")
+        fetched = await conn.fetchval("SELECT COUNT(*) FROM stops_incoming;")
+        search = await conn.fetchval("SELECT to_regclass('stops_search') IS NOT NULL;")
+        search = search and await read_search_fold(conn) == FOLD_VERSION
+        geom = ", geom = ST_SetSRID(ST_MakePoint(i.lon, i.lat), 4326)" if postgis else ""
+        if not postgis and await conn.fetchval(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'stops' AND column_name = 'geom';"
+        ):
+            # Left by an earlier PostGIS run: blank moved stops rather than leave a wrong point
+            geom = ", geom = NULL"
+
+        async with conn.transaction():
+            start_id = await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM stops;")
+            if postgis:
+                # Rows stored while PostGIS was off or before geom was added
+                await conn.execute("""
+                    UPDATE stops SET geom = ST_SetSRID(ST_MakePoint(lon, lat), 4326)
+                    WHERE geom IS NULL AND lon IS NOT NULL AND lat IS NOT NULL;
+                """)
+            await save_geom_complete(conn, postgis)
+            if search:
+                await conn.execute(f"DELETE FROM stops_search WHERE id IN (SELECT id FROM stops WHERE {GONE_STOPS});")
+            deleted = await conn.execute(f"DELETE FROM stops WHERE {GONE_STOPS};")
+            renamed = await conn.fetch(f"""
+                UPDATE stops SET name = i.name, bearing = i.bearing, lon = i.lon, lat = i.lat,
+                                 zkey = i.zkey, created_at = i.created_at{geom}
+                FROM stops_incoming i, stops old
+                WHERE i.source = stops.source AND i.stop_id = stops.stop_id AND old.id = stops.id
+                  AND (stops.name, stops.bearing, stops.lon, stops.lat) IS DISTINCT FROM (i.name, i.bearing, i.lon, i.lat)
+                RETURNING stops.id, stops.name, old.name AS old_name;
+            """)
+            inserted = await conn.execute(f"""
+                INSERT INTO stops (name, bearing, lon, lat, source, created_at, zkey, stop_id{", geom" if postgis else ""})
+                SELECT name, bearing, lon, lat, source, created_at, zkey, stop_id{", ST_SetSRID(ST_MakePoint(lon, lat), 4326)" if postgis else ""}
+                FROM stops_incoming i
+                WHERE {NEW_STOPS}
+                ORDER BY seq;
+            """)
+            updated = len(renamed)
+            if search:
+                upsert = """
+                    INSERT INTO stops_search (id, name_folded) VALUES ($1, $2)
+                    ON CONFLICT (id) DO UPDATE SET name_folded = EXCLUDED.name_folded;
+                """
+                await conn.executemany(
+                    upsert, [(r["id"], fold_name(r["name"])) for r in renamed if r["name"] != r["old_name"]],
+                )
+                async for rows in read_batches(conn, "SELECT id, name FROM stops WHERE id > $1;", start_id):
+                    await conn.executemany(upsert, [(stop_id, fold_name(name)) for stop_id, name in rows])
+        deleted = int(deleted.split()[-1])
+        inserted = int(inserted.split()[-1])
+        await conn.close()
+        synced = {"stops_search"} if search else set()
+
+    else:
+        conn = await sqlite_connect()
+        print(f"[merge.py] Connected to DB (sqlite path={sqlite_path()})", flush=True)
+        await conn.create_function("fold_name", 1, fold_name, deterministic=True)
+        await ensure_stops_table(conn)
+        await conn.execute(STOP_ID_INDEX)
+        await conn.commit()
+        # TEMP tables live outside the database file, so filling this takes no lock the API would wait on
+        await conn.execute("""
+            CREATE TEMP TABLE stops_incoming (
+                seq INTEGER PRIMARY KEY, fetcher TEXT, name TEXT, bearing TEXT, lon REAL,
+                lat REAL, source TEXT, created_at TEXT, zkey INTEGER, stop_id TEXT
+            );
+        """)
+        async for fetcher, records in batches:
+            if records is None:
+                await conn.execute("DELETE FROM stops_incoming WHERE fetcher = ?;", (fetcher,))
+                continue
+            await conn.executemany(
+                "INSERT INTO stops_incoming (fetcher, name, bearing, lon, lat, source, created_at, zkey, stop_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                [(fetcher, *r) for r in records],
+            )
+        await conn.execute("CREATE INDEX temp.idx_stops_incoming ON stops_incoming (source, stop_id);")
+        await conn.execute("""
+            DELETE FROM stops_incoming WHERE stop_id IS NOT NULL AND seq NOT IN (
+                SELECT MAX(seq) FROM stops_incoming WHERE stop_id IS NOT NULL GROUP BY source, stop_id
+            );
+        """)
+        await conn.commit()
+        cursor = await conn.execute("SELECT COUNT(*) FROM stops_incoming;")
+        fetched = (await cursor.fetchone())[0]
+        cursor = await conn.execute("SELECT name FROM sqlite_master WHERE name IN ('stops_search', 'stops_rtree');")
+        synced = {name for (name,) in await cursor.fetchall()}
+        if await read_search_fold(conn) != FOLD_VERSION:
+            # Folded by an older fold_name(): rebuilt by save_search_index() instead
+            synced.discard("stops_search")
+
+        await conn.execute("BEGIN IMMEDIATE")
+        cursor = await conn.execute("SELECT COALESCE(MAX(id), 0) FROM stops;")
+        start_id = (await cursor.fetchone())[0]
+        # Stored rows about to change, and whether their name does
+        await conn.execute("""
+            CREATE TEMP TABLE stops_changed AS
+            SELECT stops.id, stops.name IS NOT i.name AS renamed
+            FROM stops JOIN stops_incoming i ON i.source = stops.source AND i.stop_id = stops.stop_id
+            WHERE (stops.name, stops.bearing, stops.lon, stops.lat) IS NOT (i.name, i.bearing, i.lon, i.lat);
+        """)
+        if "stops_search" in synced:
+            # Contentless FTS5 rows are deleted by repeating the indexed text
+            await conn.execute(f"""
+                INSERT INTO stops_search (stops_search, rowid, name_folded)
+                SELECT 'delete', id, fold_name(name) FROM stops
+                WHERE {GONE_STOPS} OR id IN (SELECT id FROM stops_changed WHERE renamed);
+            """)
+        if "stops_rtree" in synced:
+            await conn.execute(f"DELETE FROM stops_rtree WHERE id IN (SELECT id FROM stops WHERE {GONE_STOPS});")
+        cursor = await conn.execute(f"DELETE FROM stops WHERE {GONE_STOPS};")
+        deleted = cursor.rowcount
+        cursor = await conn.execute("""
+            UPDATE stops SET name = i.name, bearing = i.bearing, lon = i.lon, lat = i.lat,
+                             zkey = i.zkey, created_at = i.created_at
+            FROM stops_incoming i
+            WHERE i.source = stops.source AND i.stop_id = stops.stop_id
+              AND stops.id IN (SELECT id FROM stops_changed);
+        """)
+        updated = cursor.rowcount
+        cursor = await conn.execute(f"""
+            INSERT INTO stops (name, bearing, lon, lat, source, created_at, zkey, stop_id)
+            SELECT name, bearing, lon, lat, source, created_at, zkey, stop_id
+            FROM stops_incoming i
+            WHERE {NEW_STOPS}
+            ORDER BY seq;
+        """)
+        inserted = cursor.rowcount
+        if "stops_search" in synced:
+            await conn.execute("""
+                INSERT INTO stops_search (rowid, name_folded)
+                SELECT id, fold_name(name) FROM stops
+                WHERE id > ? OR id IN (SELECT id FROM stops_changed WHERE renamed);
+            """, (start_id,))
+        if "stops_rtree" in synced:
+            await conn.execute("""
+                INSERT OR REPLACE INTO stops_rtree (id, min_lon, max_lon, min_lat, max_lat)
+                SELECT id, lon, lon, lat, lat FROM stops
+                WHERE (id > ? OR id IN (SELECT id FROM stops_changed)) AND lon IS NOT NULL AND lat IS NOT NULL;
+            """, (start_id,))
+        await conn.commit()
+        await conn.close()
+
+    print(
+        f"💾 Merged {fetched} fetched stops: {inserted} inserted, {updated} updated, {deleted} deleted, "
+        f"{fetched - inserted - updated} unchanged ({time.perf_counter() - started:.1f}s).",
+        flush=True,
+    )
+    return "stops", synced
+
+
+# Full Postgres merges build stops and stops_search as *_staging tables, with
+# *_staging indexes, and swap_staging() renames them over the live ones.
+STAGING_SUFFIX = "_staging"
+
+
+async def index_staging(conn, postgis: bool):
+    """
+    Give stops_staging the primary key and every index stops has, built
+    after the load rather than maintained through it, and analyze it.
+    """
+    started = time.perf_counter()
+    pkey = await conn.fetchval("SELECT conname FROM pg_constraint WHERE conrelid = 'stops'::regclass AND contype = 'p';")
+    pkey = pkey or "stops_pkey"
+    await conn.execute(f"ALTER TABLE stops_staging ADD CONSTRAINT {pkey}{STAGING_SUFFIX} PRIMARY KEY (id);")
+    rows = await conn.fetch(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = 'stops' AND indexname <> $1;",
+        pkey,
+    )
+    definitions = {row["indexname"]: row["indexdef"] for row in rows}
+    # First staged run: these aren't on stops yet
+    definitions.setdefault("idx_stops_lon_lat_zkey", SPATIAL_INDEX)
+    definitions.setdefault("idx_stops_source_stop_id", STOP_ID_INDEX)
+    if not postgis:
+        # stops_staging has no geom column
+        definitions.pop("idx_stops_geom", None)
+    for name, definition in definitions.items():
+        await conn.execute(re.sub(
+            r" INDEX (IF NOT EXISTS )?\S+ ON (ONLY )?(\S+\.)?stops ",
+            f" INDEX {name}{STAGING_SUFFIX} ON stops{STAGING_SUFFIX} ",
+            definition,
+            count=1,
+        ))
+    await conn.execute("ANALYZE stops_staging;")
+    print(f"💾 Built {len(definitions) + 1} indexes on stops_staging in {time.perf_counter() - started:.1f}s", flush=True)
+
+
+# Live tables a staged load rebuilds beside stops_staging
+STAGED_TABLES = ("stops", "stops_search", "stop_clusters", "source_stats")
+
+
+async def swap_staging(table: str) -> bool:
+    """
+    Publish a staged load (see save_to_db): in one short transaction, drop
+    the STAGED_TABLES, rename the staging tables and their indexes into
+    their place and bump the data generation. Readers see either the old
+    rows, clusters and stats or the new ones. Returns False when there was
+    nothing staged.
+    """
+    if table == "stops":
+        return False
+
+    conn = await asyncpg.connect(DB_DSN)
+    sequence = await conn.fetchval("SELECT pg_get_serial_sequence('stops', 'id');")
+    for attempt in range(1, MERGE_SWAP_ATTEMPTS + 1):
+        started = time.perf_counter()
+        try:
+            async with conn.transaction():
+                # Give up quickly instead of queueing API reads behind our lock
+                await conn.execute(f"SET LOCAL lock_timeout = {MERGE_SWAP_LOCK_TIMEOUT_MS};")
+                if sequence:
+                    # stops owns the id sequence, so dropping it would drop the sequence too
+                    await conn.execute(f"ALTER SEQUENCE {sequence} OWNED BY stops{STAGING_SUFFIX}.id;")
+                for live in STAGED_TABLES:
+                    staging = live + STAGING_SUFFIX
+                    if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL;", staging):
+                        continue
+                    indexes = await conn.fetch(
+                        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = $1;",
+                        staging,
+                    )
+                    await conn.execute(f"DROP TABLE IF EXISTS {live};")
+                    await conn.execute(f"ALTER TABLE {staging} RENAME TO {live};")
+                    for (name,) in indexes:
+                        # Renaming a primary key's index renames the constraint with it
+                        await conn.execute(f"ALTER INDEX {name} RENAME TO {name[:-len(STAGING_SUFFIX)]};")
+                    if live == "stops_search":
+                        await save_search_fold(conn)
+                    if live == "stops":
+                        # reload_stops() only keeps geom on the staged table when it filled it
+                        await save_geom_complete(conn, await conn.fetchval(
+                            "SELECT COUNT(*) > 0 FROM information_schema.columns WHERE table_name = 'stops' AND column_name = 'geom';"
+                        ))
+                generation = await next_generation(conn)
+            break
+        except asyncpg.exceptions.LockNotAvailableError:
+            if attempt == MERGE_SWAP_ATTEMPTS:
+                await conn.close()
+                raise
+            print(f"⚠️ Table swap waited {MERGE_SWAP_LOCK_TIMEOUT_MS} ms for readers, retrying ({attempt}/{MERGE_SWAP_ATTEMPTS})", flush=True)
+            await asyncio.sleep(1)
+    await conn.close()
+    print(f"🔀 Swapped in the new stops table in {(time.perf_counter() - started) * 1000:.0f} ms.", flush=True)
+    print(f"🔢 Data generation is now {generation}.", flush=True)
+    return True
+
+
+# Covers the whole ?order=spatial page selection (rowid / id is implied)
+SPATIAL_INDEX = "CREATE INDEX IF NOT EXISTS idx_stops_lon_lat_zkey ON stops (lon, lat, zkey, name);"
+
+
+async def save_zkeys(table: str = "stops"):
+    """
+    Fill stops.zkey (?order=spatial) for rows stored before the column
+    existed, and create the index the spatial bbox query reads.
+    """
+    if table != "stops":
+        # Staged rows are loaded with their zkey, and index_staging() built the index
+        return
+
+    filled = 0
+    if _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        async with conn.transaction():
+            select = "SELECT id, lon, lat FROM stops WHERE zkey IS NULL AND lon IS NOT NULL AND lat IS NOT NULL;"
+            async for rows in read_batches(conn, select):
+                await conn.executemany("UPDATE stops SET zkey = $1 WHERE id = $2;", [(zkey(lon, lat), i) for i, lon, lat in rows])
+                filled += len(rows)
+        await conn.execute(SPATIAL_INDEX)
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        # zkey() runs inside the UPDATE, so no row is read into Python
+        await conn.create_function("zkey", 2, zkey, deterministic=True)
+        cursor = await conn.execute("""
+            UPDATE stops SET zkey = zkey(lon, lat)
+            WHERE zkey IS NULL AND lon IS NOT NULL AND lat IS NOT NULL;
+        """)
+        filled = cursor.rowcount
+        await conn.execute(SPATIAL_INDEX)
+        await conn.commit()
+        await conn.close()
+
+    if filled:
+        print(f"💾 Filled spatial keys for {filled} older stops.", flush=True)
+
+
+async def save_clusters(table: str = "stops"):
+    """
+    Rebuild the per-zoom cluster pyramid (stop_clusters) from the stops in
+    `table`; from stops_staging into stop_clusters_staging, for swap_staging().
+    """
+    print("[merge.py] save_clusters: building cluster pyramid...", flush=True)
+    size = cell_size(CLUSTER_MAX_ZOOM)
+
+    if _is_postgres(DB_DSN):
+        suffix = STAGING_SUFFIX if table != "stops" else ""
+        conn = await asyncpg.connect(DB_DSN)
+        level = {}
+        async with conn.transaction():
+            cells = f"""
+                SELECT FLOOR((lon + 180.0) / $1)::int AS cx, FLOOR((lat + 90.0) / $1)::int AS cy,
+                       source, COUNT(*) AS count, SUM(lon) AS sum_lon, SUM(lat) AS sum_lat
+                FROM {table}
+                WHERE lon IS NOT NULL AND lat IS NOT NULL
+                GROUP BY 1, 2, 3;
+            """
+            async for batch in read_batches(conn, cells, size):
+                add_cells(level, batch)
+
+        saved = 0
+        async with conn.transaction():
+            if suffix:
+                await conn.execute(f"DROP TABLE IF EXISTS stop_clusters{suffix};")
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS stop_clusters{suffix} (
+                    zoom INTEGER,
+                    cx INTEGER,
+                    cy INTEGER,
+                    lon DOUBLE PRECISION,
+                    lat DOUBLE PRECISION,
+                    count INTEGER,
+                    source TEXT,
+                    CONSTRAINT stop_clusters_pkey{suffix} PRIMARY KEY (zoom, cx, cy)
+                );
+            """)
+            await conn.execute(f"DELETE FROM stop_clusters{suffix};")
+            for rows in batched(roll_up(level)):
+                await copy_records(conn, f"stop_clusters{suffix}", ["zoom", "cx", "cy", "lon", "lat", "count", "source"], rows)
+                saved += len(rows)
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        saved = await rebuild_sqlite_clusters(conn)
+        await conn.commit()
+        await conn.close()
+
+    print(f"💾 Saved {saved} clusters for zooms 0-{CLUSTER_MAX_ZOOM}.", flush=True)
+
+
+async def rebuild_sqlite_clusters(conn) -> int:
+    """Rewrite stop_clusters from stops on an SQLite `conn`, inside its transaction if any. Returns the cells saved."""
+    size = cell_size(CLUSTER_MAX_ZOOM)
+    level = {}
+    # lon + 180 and lat + 90 are never negative, so CAST truncation == floor
+    cells = """
+        SELECT CAST((lon + 180.0) / ? AS INTEGER) AS cx, CAST((lat + 90.0) / ? AS INTEGER) AS cy,
+               source, COUNT(*) AS count, SUM(lon) AS sum_lon, SUM(lat) AS sum_lat
+        FROM stops
+        WHERE lon IS NOT NULL AND lat IS NOT NULL
+        GROUP BY 1, 2, 3;
+    """
+    async for batch in read_batches(conn, cells, size, size):
+        add_cells(level, batch)
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stop_clusters (
+            zoom INTEGER,
+            cx INTEGER,
+            cy INTEGER,
+            lon REAL,
+            lat REAL,
+            count INTEGER,
+            source TEXT,
+            PRIMARY KEY (zoom, cx, cy)
+        ) WITHOUT ROWID;
+    """)
+    await conn.execute("DELETE FROM stop_clusters;")
+    saved = 0
+    for rows in batched(roll_up(level)):
         await conn.executemany(
-            "INSERT INTO stops (name, bearing, lon, lat, source, created_at) VALUES (?, ?, ?, ?, ?, ?);",
-            records,
+            "INSERT INTO stop_clusters (zoom, cx, cy, lon, lat, count, source) VALUES (?, ?, ?, ?, ?, ?, ?);",
+            rows,
         )
+        saved += len(rows)
+    return saved
+
+
+async def save_snapshot(table: str = "stops"):
+    """
+    Write the memory index snapshot (STOPS_SNAPSHOT) of the stops in `table`,
+    tagged with the generation swap_staging() or bump_generation() is about
+    to publish, so the API never sees the new generation without its snapshot.
+    """
+    if not STOPS_SNAPSHOT:
+        return
+
+    started = time.perf_counter()
+    select = f"SELECT name, bearing, lon, lat, source, zkey FROM {table} ORDER BY name, id;"
+    # Built batch by batch, so only the packed index is ever held in full
+    index = StopIndex(cell_size=STOPS_INDEX_CELL_SIZE)
+    if _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+        current = await conn.fetchval("SELECT value FROM stops_meta WHERE key = 'generation';")
+        async with conn.transaction():
+            async for rows in read_batches(conn, select):
+                index.extend(rows)
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+        cursor = await conn.execute("SELECT value FROM stops_meta WHERE key = 'generation';")
+        current = await cursor.fetchone()
+        current = current[0] if current else None
+        async for rows in read_batches(conn, select):
+            index.extend(rows)
+        await conn.close()
+
+    generation = str(int(current or 0) + 1)
+    index.finish()
+    index.save(STOPS_SNAPSHOT, generation=generation)
+    print(f"💾 Wrote snapshot {STOPS_SNAPSHOT} ({len(index)} stops, generation {generation}) in {time.perf_counter() - started:.1f}s", flush=True)
+
+
+async def next_generation(conn) -> str:
+    """Advance the Postgres data generation on `conn`, inside its transaction if any."""
+    await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+    return await conn.fetchval("""
+        INSERT INTO stops_meta (key, value) VALUES ('generation', '1')
+        ON CONFLICT (key) DO UPDATE SET value = (stops_meta.value::bigint + 1)::text
+        RETURNING value;
+    """)
+
+
+async def bump_generation():
+    """Advance the data generation in stops_meta so API caches and ETags roll over."""
+    if _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        generation = await next_generation(conn)
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+        await conn.execute("""
+            INSERT INTO stops_meta (key, value) VALUES ('generation', '1')
+            ON CONFLICT (key) DO UPDATE SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT);
+        """)
+        cursor = await conn.execute("SELECT value FROM stops_meta WHERE key = 'generation';")
+        generation = (await cursor.fetchone())[0]
         await conn.commit()
         await conn.close()
-        print(f"💾 Inserted {len(records)} merged stops into database.", flush=True)
 
+    print(f"🔢 Data generation is now {generation}.", flush=True)
+
+
+async def save_rtree():
+    """Rebuild stops_rtree, the SQLite R*Tree the API's bbox queries join through."""
+    if _is_postgres(DB_DSN):
+        return
+
+    print("[merge.py] save_rtree: building R*Tree...", flush=True)
+    conn = await sqlite_connect()
+    # One transaction, so the API keeps using the old tree until commit
+    await conn.execute("BEGIN")
+    await conn.execute("DROP TABLE IF EXISTS stops_rtree;")
+    await conn.execute("CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat);")
+    cursor = await conn.execute("""
+        INSERT INTO stops_rtree (id, min_lon, max_lon, min_lat, max_lat)
+        SELECT id, lon, lon, lat, lat
+        FROM stops
+        WHERE lon IS NOT NULL AND lat IS NOT NULL;
+    """)
+    await conn.commit()
+    await conn.close()
+    print(f"💾 Indexed {cursor.rowcount} stops in the R*Tree.", flush=True)
 
-async def fetch_all_sources():
-    """Fetch all sources concurrently, or just one if SINGLE_SOURCE is set."""
+
+# Postgres: finds the names starting with a query (name_folded LIKE 'q%') in order
+SEARCH_PREFIX_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_stops_search_prefix{suffix}
+    ON stops_search{suffix} (name_folded text_pattern_ops);
+"""
+
+
+async def save_search_index(table: str = "stops"):
+    """
+    Rebuild stops_search, the accent/case-folded name index behind
+    /api/stops/search, for the stops in `table` (see save_to_db).
+    """
+    print("[merge.py] save_search_index: folding stop names...", flush=True)
+    indexed = 0
+
+    if _is_postgres(DB_DSN) and table != "stops":
+        # Built beside stops_staging and swapped in with it, so the ids match
+        conn = await asyncpg.connect(DB_DSN)
+        await conn.execute("DROP TABLE IF EXISTS stops_search_staging;")
+        await conn.execute("CREATE TABLE stops_search_staging (id INTEGER, name_folded TEXT);")
+        async with conn.transaction():
+            async for rows in read_batches(conn, f"SELECT id, name FROM {table};"):
+                batch = [(stop_id, fold_name(name)) for stop_id, name in rows]
+                await copy_records(conn, "stops_search_staging", ["id", "name_folded"], batch)
+                indexed += len(batch)
+        await conn.execute("ALTER TABLE stops_search_staging ADD CONSTRAINT stops_search_pkey_staging PRIMARY KEY (id);")
+        await conn.execute("""
+            CREATE INDEX idx_stops_search_tsv_staging
+            ON stops_search_staging USING GIN (to_tsvector('simple', name_folded));
+        """)
+        await conn.execute(SEARCH_PREFIX_INDEX.format(suffix=STAGING_SUFFIX))
+        await conn.execute("ANALYZE stops_search_staging;")
+        await conn.close()
+
+    elif _is_postgres(DB_DSN):
+        conn = await asyncpg.connect(DB_DSN)
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS stops_search (
+                    id INTEGER PRIMARY KEY,
+                    name_folded TEXT
+                );
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_stops_search_tsv
+                ON stops_search USING GIN (to_tsvector('simple', name_folded));
+            """)
+            await conn.execute(SEARCH_PREFIX_INDEX.format(suffix=""))
+            await conn.execute("DELETE FROM stops_search;")
+            async for rows in read_batches(conn, "SELECT id, name FROM stops;"):
+                batch = [(stop_id, fold_name(name)) for stop_id, name in rows]
+                await copy_records(conn, "stops_search", ["id", "name_folded"], batch)
+                indexed += len(batch)
+            await save_search_fold(conn)
+        await conn.execute("ANALYZE stops_search;")
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        # One transaction, so the API keeps searching the old index until commit
+        await conn.execute("BEGIN")
+        await conn.execute("DROP TABLE IF EXISTS stops_search;")
+        # Contentless (rows join back to stops by rowid), prefix indexes for 1-3 chars
+        await conn.execute("""
+            CREATE VIRTUAL TABLE stops_search USING fts5(
+                name_folded, content='', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+            );
+        """)
+        async for rows in read_batches(conn, "SELECT id, name FROM stops;"):
+            await conn.executemany(
+                "INSERT INTO stops_search (rowid, name_folded) VALUES (?, ?);",
+                [(stop_id, fold_name(name)) for stop_id, name in rows],
+            )
+            indexed += len(rows)
+        await conn.execute("INSERT INTO stops_search (stops_search) VALUES ('optimize');")
+        await save_search_fold(conn)
+        await conn.commit()
+        await conn.close()
+
+    print(f"💾 Indexed {indexed} stop names for search.", flush=True)
+
+
+async def read_search_fold(conn) -> Optional[str]:
+    """The fold_name() version stops_search was built with, from stops_meta (None if unknown)."""
+    if _is_postgres(DB_DSN):
+        if not await conn.fetchval("SELECT to_regclass('stops_meta') IS NOT NULL;"):
+            return None
+        return await conn.fetchval("SELECT value FROM stops_meta WHERE key = 'search_fold';")
+    try:
+        cursor = await conn.execute("SELECT value FROM stops_meta WHERE key = 'search_fold';")
+    except aiosqlite.OperationalError:
+        return None
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def save_search_fold(conn):
+    """Record in stops_meta that stops_search was just rebuilt with the current fold_name()."""
+    if _is_postgres(DB_DSN):
+        await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+        await conn.execute("""
+            INSERT INTO stops_meta (key, value) VALUES ('search_fold', $1)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+        """, FOLD_VERSION)
+    else:
+        await conn.execute("CREATE TABLE IF NOT EXISTS stops_meta (key TEXT PRIMARY KEY, value TEXT);")
+        await conn.execute("""
+            INSERT INTO stops_meta (key, value) VALUES ('search_fold', ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+        """, (FOLD_VERSION,))
+
+
+SOURCE_STATS_COLUMNS = (
+    "source", "stops_count", "min_lon", "max_lon", "min_lat", "max_lat", "last_update",
+    "fetch_seconds", "bytes_downloaded", "updated_at",
+)
+
+SOURCE_STATS_QUERY = """
+    SELECT source, COUNT(*), MIN(lon), MAX(lon), MIN(lat), MAX(lat), MAX(created_at)
+    FROM {table}
+    GROUP BY source;
+"""
+
+
+def build_source_stats(aggregates, fetch_stats: Dict[str, Dict[str, Any]], updated_at: str):
+    """Rows for source_stats: one per stop source, counts and extents joined with its fetch figures."""
+    rows = []
+    for source, count, min_lon, max_lon, min_lat, max_lat, last_update in aggregates:
+        fetched = fetch_stats.get(source, {})
+        rows.append((
+            source, count, min_lon, max_lon, min_lat, max_lat, last_update,
+            fetched.get("fetch_seconds"), fetched.get("bytes_downloaded"), fetched.get("updated_at", updated_at),
+        ))
+    return rows
+
+
+async def save_source_stats(fetch_stats: Dict[str, Dict[str, Any]], table: str = "stops"):
+    """
+    Rewrite source_stats, the small table /data is served from: per-source stop
+    count, lon/lat extent, newest created_at, and how long the fetch took and how
+    many bytes it downloaded. A source missing from `fetch_stats` (not fetched
+    in single-source mode, or its fetch failed) keeps its previous fetch
+    figures. A staged load (`table` stops_staging) goes
+    to source_stats_staging, for swap_staging().
+    """
+    print("[merge.py] save_source_stats: aggregating stops per source...", flush=True)
+    updated_at = datetime.datetime.utcnow().isoformat()
+    fetch_stats = {source: {**stats, "updated_at": updated_at} for source, stats in fetch_stats.items()}
+    columns = ", ".join(SOURCE_STATS_COLUMNS)
+
+    if _is_postgres(DB_DSN):
+        suffix = STAGING_SUFFIX if table != "stops" else ""
+        conn = await asyncpg.connect(DB_DSN)
+        async with conn.transaction():
+            if suffix:
+                await conn.execute(f"DROP TABLE IF EXISTS source_stats{suffix};")
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS source_stats{suffix} (
+                    source TEXT,
+                    stops_count BIGINT,
+                    min_lon DOUBLE PRECISION,
+                    max_lon DOUBLE PRECISION,
+                    min_lat DOUBLE PRECISION,
+                    max_lat DOUBLE PRECISION,
+                    last_update TEXT,
+                    fetch_seconds DOUBLE PRECISION,
+                    bytes_downloaded BIGINT,
+                    updated_at TEXT,
+                    CONSTRAINT source_stats_pkey{suffix} PRIMARY KEY (source)
+                );
+            """)
+            if await conn.fetchval("SELECT to_regclass('source_stats') IS NOT NULL;"):
+                previous = await conn.fetch("SELECT source, fetch_seconds, bytes_downloaded, updated_at FROM source_stats;")
+                fetch_stats = {**{row["source"]: dict(row) for row in previous}, **fetch_stats}
+            rows = build_source_stats(await conn.fetch(SOURCE_STATS_QUERY.format(table=table)), fetch_stats, updated_at)
+            await conn.execute(f"DELETE FROM source_stats{suffix};")
+            await conn.executemany(
+                f"INSERT INTO source_stats{suffix} ({columns}) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10);",
+                rows,
+            )
+        await conn.close()
+
+    else:
+        conn = await sqlite_connect()
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS source_stats (
+                source TEXT PRIMARY KEY,
+                stops_count INTEGER,
+                min_lon REAL,
+                max_lon REAL,
+                min_lat REAL,
+                max_lat REAL,
+                last_update TEXT,
+                fetch_seconds REAL,
+                bytes_downloaded INTEGER,
+                updated_at TEXT
+            );
+        """)
+        cursor = await conn.execute("SELECT source, fetch_seconds, bytes_downloaded, updated_at FROM source_stats;")
+        previous = await cursor.fetchall()
+        fetch_stats = {**{row["source"]: dict(row) for row in previous}, **fetch_stats}
+        cursor = await conn.execute(SOURCE_STATS_QUERY.format(table=table))
+        rows = build_source_stats(await cursor.fetchall(), fetch_stats, updated_at)
+        await conn.execute("DELETE FROM source_stats;")
+        await conn.executemany(
+            f"INSERT INTO source_stats ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            rows,
+        )
+        await conn.commit()
+        await conn.close()
+
+    print(f"💾 Saved stats for {len(rows)} sources.", flush=True)
+
+
+# Bytes downloaded by the fetcher running in the current task, so they can be
+# attributed per source although all fetchers share a client.
+fetch_downloads: contextvars.ContextVar = contextvars.ContextVar("fetch_downloads", default=None)
+
+
+async def record_response(response: httpx.Response):
+    """
+    httpx response hook: add the response's size to the current fetcher's
+    count. Only the count is kept, not the response and its body. The
+    fetchers read every body whole anyway.
+    """
+    downloads = fetch_downloads.get()
+    if downloads is not None:
+        await response.aread()
+        downloads["bytes"] += response.num_bytes_downloaded
+
+
+async def fetch_batches(fetch) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Batches of at most MERGE_BATCH_ROWS stops from one fetcher. A fetcher is
+    either a coroutine returning its whole list, or an async generator
+    yielding lists as it downloads them, which keeps the source out of memory.
+    """
+    if hasattr(fetch, "__aiter__"):
+        async for stops in fetch:
+            for start in range(0, len(stops), MERGE_BATCH_ROWS):
+                yield stops[start:start + MERGE_BATCH_ROWS]
+    else:
+        stops = await fetch
+        for start in range(0, len(stops), MERGE_BATCH_ROWS):
+            yield stops[start:start + MERGE_BATCH_ROWS]
+
+
+async def pump_source(source: str, fetch, queue: asyncio.Queue, slots: asyncio.Semaphore, fetch_stats: Dict[str, Dict[str, Any]]):
+    """
+    Run one fetcher and put its stops on the queue as (source, records)
+    batches, dumping the raw data as it goes. A failed fetch puts
+    (source, None), so the writer drops what it already inserted.
+    """
+    async with slots:
+        # Runs in its own task (asyncio.gather), so this doesn't leak to other fetchers
+        downloads = {"bytes": 0}
+        fetch_downloads.set(downloads)
+        started = time.perf_counter()
+        dump = SourceDump(source)
+        fetched = 0
+        stop_sources = set()
+        try:
+            async for batch in fetch_batches(fetch):
+                for item in batch:
+                    item.setdefault("source", source)
+                    stop_sources.add(item["source"])
+                await dump.write(batch)
+                fetched += len(batch)
+                records = [record for record in map(stop_record, batch) if record is not None]
+                if records:
+                    # Waits while the writer is MERGE_QUEUE_BATCHES behind
+                    await queue.put((source, records))
+            await dump.finish()
+        except Exception as e:
+            print(f"⚠️ Error fetching {source}: {e}", flush=True)
+            await dump.discard()
+            await queue.put((source, None))
+            return
+
+    seconds = time.perf_counter() - started
+    downloaded = downloads["bytes"]
+    print(f"Fetched {fetched} stops from {source} in {seconds:.1f}s ({downloaded} bytes)", flush=True)
+
+    # Keyed by the stops' own source (uk → ukbuses); fetchers run concurrently
+    for stop_source in stop_sources or {source}:
+        stats = fetch_stats.setdefault(stop_source, {"fetch_seconds": 0.0, "bytes_downloaded": 0})
+        stats["fetch_seconds"] = max(stats["fetch_seconds"], round(seconds, 3))
+        stats["bytes_downloaded"] += downloaded
+
+
+async def fetch_all_sources(queue: asyncio.Queue):
+    """
+    Fetch all sources concurrently, or just one if SINGLE_SOURCE is set,
+    putting their stops on `queue` batch by batch (see pump_source).
+    Returns per-source fetch_seconds / bytes_downloaded.
+    """
     print("[merge.py] fetch_all_sources: Starting", flush=True)
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(event_hooks={"response": [record_response]}) as client:
         print("[merge.py] fetch_all_sources: AsyncClient created", flush=True)
 
         # Available fetchers
@@ -383,42 +1526,55 @@ async def fetch_all_sources():
             tasks = {name: fn(client=client, debug=debug) for name, fn in available.items()}
 
         print(f"[merge.py] fetch_all_sources: Fetching {list(tasks.keys())}", flush=True)
-        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        fetch_stats: Dict[str, Dict[str, Any]] = {}
+        slots = asyncio.Semaphore(MERGE_FETCH_CONCURRENCY or len(tasks))
+        await asyncio.gather(*(pump_source(source, fetch, queue, slots, fetch_stats) for source, fetch in tasks.items()))
         print("[merge.py] fetch_all_sources: Tasks complete", flush=True)
+        return fetch_stats
 
-        merged: List[Dict[str, Any]] = []
-        for (source, result) in zip(tasks.keys(), results):
-            if isinstance(result, Exception):
-                print(f"⚠️ Error fetching {source}: {result}", flush=True)
-                continue
 
-            await dump_source_data(source, result)
-            for item in result:
-                item.setdefault("source", source)
-            merged.extend(result)
-            print(f"Fetched {len(result)} stops from {source}", flush=True)
+async def queued_batches(queue: asyncio.Queue, fetching: asyncio.Task):
+    """Drain the fetch queue until the fetch task is done (its None marker)."""
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            # Re-raises a failed fetch before save_to_db commits anything
+            await fetching
+            return
+        yield batch
+
 
-        print(f"[merge.py] fetch_all_sources: Returning {len(merged)} total stops", flush=True)
-        return merged
+async def fetch_into(queue: asyncio.Queue):
+    """fetch_all_sources(), then the None marker that ends queued_batches()."""
+    try:
+        return await fetch_all_sources(queue)
+    finally:
+        await queue.put(None)
 
 
 async def main():
     print("[merge.py] main() started", flush=True)
     print("🚀 Fetching and merging stop data...", flush=True)
-    data = await fetch_all_sources()
-
-    print(f"📦 Merging {len(data)} total stops...", flush=True)
-    # Normalise and drop entries that don't have lat/lon
-    normalized = []
-    for s in data:
-        norm = normalize_for_db(s)
-        if norm["location"][0] is not None and norm["location"][1] is not None:
-            normalized.append(norm)
-
-    print(f"[merge.py] Normalized {len(normalized)} stops", flush=True)
+    # Fetchers normalize into the queue while save_to_db inserts from it
+    await begin_sqlite_build()
+    queue = asyncio.Queue(maxsize=MERGE_QUEUE_BATCHES)
+    fetching = asyncio.create_task(fetch_into(queue))
+    table, synced = await save_to_db(queued_batches(queue, fetching), source_only=SINGLE_SOURCE)
+    fetch_stats = await fetching
 
-    print(f"[merge.py] Saving to DB...", flush=True)
-    await save_to_db(normalized, source_only=SINGLE_SOURCE)
+    # A staged load builds everything beside stops_staging, then publishes
+    # it all, generation included, in swap_staging()'s one transaction
+    if "stops_search" not in synced:
+        await save_search_index(table)
+    await save_zkeys(table)
+    await save_clusters(table)
+    if "stops_rtree" not in synced:
+        await save_rtree()
+    await save_source_stats(fetch_stats, table=table)
+    await save_snapshot(table)
+    if not await swap_staging(table):
+        await bump_generation()
+    await publish_sqlite_build()
     print("✅ Merge complete.", flush=True)
 
 
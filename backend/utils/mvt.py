@@ -0,0 +1,105 @@
+"""
+Minimal Mapbox Vector Tile (v2.1) encoder for point layers.
+
+Only what /api/tiles needs: one layer of POINT features with string
+attributes, written straight to protobuf wire format so no protobuf
+dependency is required.
+"""
+
+import math
+from typing import Any, Dict, Iterable, List, Tuple
+
+DEFAULT_EXTENT = 4096
+MAX_LAT = 85.0511287798066
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Return (xmin, xmax, ymin, ymax) in lon/lat for a Web Mercator tile."""
+    n = 2 ** z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0, lat(y + 1), lat(y)
+
+
+def project(lon: float, lat: float, z: int, x: int, y: int, extent: int = DEFAULT_EXTENT) -> Tuple[int, int]:
+    """Project lon/lat to integer tile coordinates (0..extent inside the tile)."""
+    n = 2 ** z
+    lat = max(min(lat, MAX_LAT), -MAX_LAT)
+    rad = math.radians(lat)
+    fx = (lon + 180.0) / 360.0 * n
+    fy = (1.0 - math.log(math.tan(rad) + 1.0 / math.cos(rad)) / math.pi) / 2.0 * n
+    return int(round((fx - x) * extent)), int(round((fy - y) * extent))
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 31)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    """Length-delimited field (wire type 2)."""
+    return _varint((number << 3) | 2) + _varint(len(payload)) + payload
+
+
+def _uint_field(number: int, value: int) -> bytes:
+    """Varint field (wire type 0)."""
+    return _varint(number << 3) + _varint(value)
+
+
+def _packed(values: Iterable[int]) -> bytes:
+    return b"".join(_varint(v) for v in values)
+
+
+def encode_point_layer(
+    name: str,
+    features: List[Tuple[int, int, Dict[str, Any]]],
+    extent: int = DEFAULT_EXTENT,
+) -> bytes:
+    """
+    Encode a tile with a single point layer.
+
+    features is a list of (tile_x, tile_y, attributes). None attribute values
+    are left out; everything else is stored as a string value.
+    """
+    keys: Dict[str, int] = {}
+    values: Dict[str, int] = {}
+    encoded = []
+
+    for px, py, attrs in features:
+        tags = []
+        for key, value in attrs.items():
+            if value is None:
+                continue
+            value = str(value)
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value, len(values)))
+        geometry = (9, _zigzag(px), _zigzag(py))  # MoveTo, count 1
+        feature = (
+            _field(2, _packed(tags))
+            + _uint_field(3, 1)  # GeomType.POINT
+            + _field(4, _packed(geometry))
+        )
+        encoded.append(_field(2, feature))
+
+    if not encoded:
+        return b""
+
+    layer = bytearray(_uint_field(15, 2) + _field(1, name.encode("utf-8")))
+    for feature in encoded:
+        layer += feature
+    for key in keys:
+        layer += _field(3, key.encode("utf-8"))
+    for value in values:
+        layer += _field(4, _field(1, value.encode("utf-8")))
+    layer += _uint_field(5, extent)
+    return _field(3, bytes(layer))
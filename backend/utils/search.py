@@ -0,0 +1,79 @@
+"""
+Stop name search shared by utils/merge.py (which builds the index) and the
+API (which queries it).
+
+Names are folded once at merge time: NFKD, combining marks dropped,
+apostrophes dropped, lower case, words joined by single spaces, so
+"Kauppatori" matches "kauppatori", "Zürich" matches "zurich" and
+"King's Cross" matches "kings cro".
+Queries are folded the same way and split into word tokens. Every token
+must appear in the name, and the last one may be a prefix, which is what an
+autocomplete box sends while the user is typing.
+
+SQLite keeps the folded names in a contentless FTS5 table (stops_search,
+rowid = stops.id) with prefix indexes for 1-3 characters, so short prefixes
+don't expand into thousands of terms. Postgres keeps them in a plain table
+with a GIN index on their tsvector, and a text_pattern_ops B-tree that
+finds the names starting with the query with LIKE.
+"""
+
+import re
+import unicodedata
+from typing import List, Optional
+
+TOKEN_RE = re.compile(r"\w+")
+# Dropped rather than split on, so "King's" is the single token "kings"
+APOSTROPHES = str.maketrans("", "", "'\u2019\u02bc")
+# Stored in stops_meta with stops_search; bump it whenever fold_name()
+# changes, so the next merge rebuilds the index instead of patching it.
+FOLD_VERSION = "3"
+
+
+def fold_name(name: Optional[str]) -> str:
+    """Accent- and case-folded form of a stop name: its words, space separated."""
+    if not name:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", name)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).translate(APOSTROPHES).lower()
+    return " ".join(TOKEN_RE.findall(folded))
+
+
+def query_tokens(q: str) -> List[str]:
+    """Folded word tokens of a search query."""
+    return TOKEN_RE.findall(fold_name(q))
+
+
+def fts5_match(tokens: List[str]) -> str:
+    """FTS5 MATCH expression: all tokens, the last one as a prefix."""
+    return " ".join(f'"{t}"' for t in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+
+def fts5_starts(tokens: List[str]) -> str:
+    """FTS5 MATCH expression for names that start with the tokens, the last one as a prefix."""
+    return f'^"{" ".join(tokens)}"*'
+
+
+def pg_starts(tokens: List[str]) -> str:
+    """Postgres LIKE pattern on name_folded for names that start with the tokens, the last one as a prefix."""
+    # "_" is a word character, and a LIKE wildcard
+    return " ".join(tokens).replace("_", r"\_") + "%"
+
+
+def pg_tsquery(tokens: List[str]) -> str:
+    """Postgres to_tsquery('simple', ...) expression: all tokens, the last one as a prefix."""
+    return " & ".join(tokens[:-1] + [f"{tokens[-1]}:*"])
+
+
+def rank(results: List[dict], tokens: List[str]) -> List[dict]:
+    """
+    Order matches: names starting with the query first, then shorter
+    names, then by name. The API ranks a bounded window of matches (see
+    SEARCH_RANK_WINDOW), not every match of the index.
+    """
+    prefix = " ".join(tokens)
+
+    def key(stop):
+        folded = " ".join(query_tokens(stop["name"] or ""))
+        return (not folded.startswith(prefix), len(folded), folded)
+
+    return sorted(results, key=key)
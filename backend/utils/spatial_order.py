@@ -0,0 +1,39 @@
+"""
+Progressive spatial order for bbox results (?order=spatial).
+
+Every stop gets a zkey: its Morton (Z-order) code on a 2^31 x 2^31 lon/lat
+grid, with the 62 bits reversed. Plain Z-order keeps neighbours together, so
+a LIMIT cut-off would return one corner of the bbox. Reversed, the
+least significant (finest) bits lead and the coarse position trails: stops
+follow each other in a scattered, stratified order, and any prefix of the
+sorted result is spread over the whole bbox, in proportion to stop density.
+
+The key is computed once per stop by utils/merge.py and stored in
+stops.zkey; it fits a signed 64-bit integer in both SQLite and Postgres.
+"""
+
+BITS = 31
+SCALE = (1 << BITS) - 1
+KEY_BITS = 2 * BITS
+
+
+def _spread(n: int) -> int:
+    """Move the bits of a 31-bit integer to the even bit positions."""
+    n = (n | (n << 16)) & 0x0000FFFF0000FFFF
+    n = (n | (n << 8)) & 0x00FF00FF00FF00FF
+    n = (n | (n << 4)) & 0x0F0F0F0F0F0F0F0F
+    n = (n | (n << 2)) & 0x3333333333333333
+    n = (n | (n << 1)) & 0x5555555555555555
+    return n
+
+
+def morton(lon: float, lat: float) -> int:
+    """Z-order code of a point on the 2^31 x 2^31 grid."""
+    x = min(max(int((lon + 180.0) / 360.0 * SCALE), 0), SCALE)
+    y = min(max(int((lat + 90.0) / 180.0 * SCALE), 0), SCALE)
+    return _spread(x) | (_spread(y) << 1)
+
+
+def zkey(lon: float, lat: float) -> int:
+    """Bit-reversed Morton code: the sort key of ?order=spatial."""
+    return int(format(morton(lon, lat), f"0{KEY_BITS}b")[::-1], 2)
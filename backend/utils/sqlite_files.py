@@ -0,0 +1,91 @@
+"""
+Blue/green SQLite database files.
+
+A full merge doesn't write into the database the API is reading. It builds
+a new file next to the configured one (stops.db → stops-7.db for data
+generation 7) and publishes it by rewriting the pointer file
+stops.db.current, which names the live file. The pointer is replaced with
+a rename, so it always names one complete database.
+
+The API opens the file the pointer names (the configured path itself when
+there is no pointer) and moves to a new one when the pointer changes.
+Connections still reading the old file finish on it. The previous build is
+kept for workers that haven't noticed the switch yet; older ones are removed.
+
+Renaming the new database over stops.db instead would not be safe: readers
+in WAL mode would pair the new file with the old file's -wal and -shm.
+"""
+
+import os
+from typing import Iterable
+
+POINTER_SUFFIX = ".current"
+# Files SQLite keeps next to a database
+SIDE_SUFFIXES = ("-wal", "-shm", "-journal")
+
+
+def database_path(url: str) -> str:
+    """File path of a sqlite:/// URL (or a plain path)."""
+    if url.startswith("sqlite:///"):
+        return url.split("sqlite:///", 1)[1]
+    return url
+
+
+def pointer_path(path: str) -> str:
+    return path + POINTER_SUFFIX
+
+
+def live_path(path: str) -> str:
+    """The database file currently published for the configured `path`."""
+    try:
+        with open(pointer_path(path), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return path
+    return os.path.join(os.path.dirname(path), name) if name else path
+
+
+def build_path(path: str, generation: str) -> str:
+    """Where the build of `generation` goes: stops.db → stops-7.db."""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}-{generation}{ext}"
+
+
+def remove_database(path: str):
+    """Delete a database file and its -wal / -shm / -journal files."""
+    for name in (path, *(path + suffix for suffix in SIDE_SUFFIXES)):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def publish(path: str, build: str):
+    """Make `build` the live database for `path`: write the pointer next to it and rename it into place."""
+    tmp_path = pointer_path(path) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(build) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path(path))
+    # Persist the rename itself
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def remove_old_builds(path: str, keep: Iterable[str]):
+    """Delete the builds of `path` (stops-<n>.db) other than the ones in `keep`."""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    directory = os.path.dirname(os.path.abspath(path))
+    keep = {os.path.abspath(k) for k in keep}
+    for name in os.listdir(directory):
+        generation = name[len(stem) + 1:-len(ext)] if ext else name[len(stem) + 1:]
+        if not (name.startswith(stem + "-") and name.endswith(ext) and generation.isdigit()):
+            continue
+        build = os.path.join(directory, name)
+        if build not in keep:
+            remove_database(build)
+            print(f"🗑️ Removed old database {build}", flush=True)
@@ -0,0 +1,304 @@
+"""
+In-memory spatial index used by the API when STOPS_ENGINE=memory.
+
+Stops are packed into flat arrays (no per-stop Python objects) and bucketed
+into a fixed lon/lat grid. The grid is stored "packed": every stop gets an
+integer cell key, the keys are sorted, and a bbox lookup is one binary search
+per grid column followed by an exact coordinate check.
+
+Rows must be loaded in the same order the SQL path sorts by (name, id), so the
+load position doubles as the sort rank and results match the database exactly.
+Each row also carries its zkey (utils/spatial_order.py); finish() turns the
+zkeys into a second rank order for ?order=spatial.
+
+A finished index can be saved as a read-only snapshot file (save / open).
+The file is the flat arrays back to back behind a JSON header; open() maps
+it and reads the arrays in place, so every worker process that opens the
+same snapshot shares one copy of it in the page cache.
+"""
+
+import heapq
+import json
+import math
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_CELL_SIZE = 0.1  # degrees
+DEFAULT_COLUMNS = ("name", "bearing", "lon", "lat")
+
+SNAPSHOT_MAGIC = b"STOPIDX1"
+# Flat arrays stored in a snapshot, with their array typecodes
+SNAPSHOT_ARRAYS = (
+    ("lon", "d"),
+    ("lat", "d"),
+    ("name_offsets", "Q"),
+    ("names", "B"),
+    ("bearing_offsets", "Q"),
+    ("bearings", "B"),
+    ("source_codes", "H"),
+    ("keys", "q"),
+    ("ranks", "I"),
+    ("spatial_ranks", "I"),
+    ("spatial_pos", "I"),
+)
+
+
+class StopIndex:
+    def __init__(self, cell_size: float = DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.generation = None  # data generation of a snapshot
+        self.nx = int(math.ceil(360.0 / cell_size)) + 1
+        self.ny = int(math.ceil(180.0 / cell_size)) + 1
+
+        # Per-stop columns, in rank (name, id) order
+        self.lon = array("d")
+        self.lat = array("d")
+        self.name_offsets = array("Q", [0])
+        self.names = bytearray()
+        self.bearing_offsets = array("Q", [0])
+        self.bearings = bytearray()
+        self.null_names = set()
+        self.null_bearings = set()
+        self.source_codes = array("H")
+        self.sources: List[Optional[str]] = []
+
+        # Packed grid, in cell-key order: key and the rank it points at
+        self.keys = array("q")
+        self.ranks = array("I")
+
+        # Ranks in (zkey, name, id) order and each rank's position in it
+        self.spatial_ranks = array("I")
+        self.spatial_pos = array("I")
+
+        # Build state, dropped by finish()
+        self._pending_keys = array("q")
+        self.zkeys = array("q")
+        self._source_lookup: Dict[Optional[str], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.lon)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[Any, ...]], cell_size: float = DEFAULT_CELL_SIZE) -> "StopIndex":
+        """
+        Build an index from (name, bearing, lon, lat, source, zkey) rows
+        already sorted by (name, id). Rows without coordinates are skipped, as they can
+        never match a bbox.
+        """
+        index = cls(cell_size)
+        index.extend(rows)
+        index.finish()
+        return index
+
+    def extend(self, rows: Iterable[Tuple[Any, ...]]):
+        """Append a batch of rows (see from_rows); call finish() after the last batch."""
+        keys = self._pending_keys
+        source_lookup = self._source_lookup
+        for name, bearing, lon, lat, source, zkey in rows:
+            if lon is None or lat is None:
+                continue
+            rank = len(self.lon)
+            self.lon.append(lon)
+            self.lat.append(lat)
+            self.zkeys.append(zkey or 0)
+            if name is None:
+                self.null_names.add(rank)
+            else:
+                self.names += name.encode("utf-8")
+            self.name_offsets.append(len(self.names))
+            if bearing is None:
+                self.null_bearings.add(rank)
+            else:
+                self.bearings += bearing.encode("utf-8")
+            self.bearing_offsets.append(len(self.bearings))
+            if source not in source_lookup:
+                source_lookup[source] = len(self.sources)
+                self.sources.append(source)
+            self.source_codes.append(source_lookup[source])
+            keys.append(self._cell_key(lon, lat))
+
+    def finish(self):
+        """Sort the grid keys; the index is queryable afterwards."""
+        keys = self._pending_keys
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = array("q", (keys[i] for i in order))
+        self.ranks = array("I", order)
+        # Stable sort: zkey ties stay in rank, i.e. (name, id), order
+        self.spatial_ranks = array("I", sorted(range(len(self.zkeys)), key=self.zkeys.__getitem__))
+        self.spatial_pos = array("I", bytes(4 * len(self.spatial_ranks)))
+        for pos, r in enumerate(self.spatial_ranks):
+            self.spatial_pos[r] = pos
+        self.zkeys = None
+        self._pending_keys = None
+        self._source_lookup = None
+
+    def save(self, path: str, generation: Optional[str] = None):
+        """
+        Write the finished index to a snapshot file. The file is written
+        next to `path` and renamed over it, so readers never see half a file.
+        """
+        sections = {}
+        offset = 0
+        for name, typecode in SNAPSHOT_ARRAYS:
+            values = getattr(self, name)
+            size = len(values) * array(typecode).itemsize
+            sections[name] = [typecode, offset, len(values)]
+            offset += size + (-size % 8)  # keep every array 8-byte aligned
+        header = json.dumps({
+            "byteorder": sys.byteorder,
+            "cell_size": self.cell_size,
+            "generation": generation,
+            "sources": self.sources,
+            "null_names": sorted(self.null_names),
+            "null_bearings": sorted(self.null_bearings),
+            "sections": sections,
+        }).encode("utf-8")
+        header += b" " * (-(len(SNAPSHOT_MAGIC) + 8 + len(header)) % 8)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for name, typecode in SNAPSHOT_ARRAYS:
+                data = memoryview(getattr(self, name)).cast("B")
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path: str) -> "StopIndex":
+        """Map a snapshot written by save(); the arrays are read in place, never copied."""
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a stops snapshot")
+        start = len(SNAPSHOT_MAGIC) + 8
+        header_size = int.from_bytes(mapped[len(SNAPSHOT_MAGIC):start], "little")
+        header = json.loads(mapped[start:start + header_size])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written on a {header['byteorder']}-endian machine")
+
+        index = cls(header["cell_size"])
+        index.generation = header["generation"]
+        index.sources = header["sources"]
+        index.null_names = set(header["null_names"])
+        index.null_bearings = set(header["null_bearings"])
+        data = memoryview(mapped)[start + header_size:]
+        for name, (typecode, offset, length) in header["sections"].items():
+            size = length * array(typecode).itemsize
+            setattr(index, name, data[offset:offset + size].cast(typecode))
+        index.zkeys = None
+        index._pending_keys = None
+        index._source_lookup = None
+        index._mmap = mapped
+        return index
+
+    def _cell_x(self, lon: float) -> int:
+        return min(max(int((lon + 180.0) // self.cell_size), 0), self.nx - 1)
+
+    def _cell_y(self, lat: float) -> int:
+        return min(max(int((lat + 90.0) // self.cell_size), 0), self.ny - 1)
+
+    def _cell_key(self, lon: float, lat: float) -> int:
+        return self._cell_x(lon) * self.ny + self._cell_y(lat)
+
+    def _name(self, rank: int) -> Optional[str]:
+        if rank in self.null_names:
+            return None
+        return str(self.names[self.name_offsets[rank]:self.name_offsets[rank + 1]], "utf-8")
+
+    def _bearing(self, rank: int) -> Optional[str]:
+        if rank in self.null_bearings:
+            return None
+        return str(self.bearings[self.bearing_offsets[rank]:self.bearing_offsets[rank + 1]], "utf-8")
+
+    def _value(self, rank: int, column: str) -> Any:
+        if column == "name":
+            return self._name(rank)
+        if column == "bearing":
+            return self._bearing(rank)
+        if column == "lon":
+            return self.lon[rank]
+        if column == "lat":
+            return self.lat[rank]
+        if column == "source":
+            return self.sources[self.source_codes[rank]]
+        raise KeyError(column)
+
+    def search(self, xmin: float, xmax: float, ymin: float, ymax: float) -> List[int]:
+        """Return the ranks of all stops inside the bbox (inclusive), unordered."""
+        if xmin > xmax or ymin > ymax or not self.keys:
+            return []
+
+        keys, ranks, lon, lat = self.keys, self.ranks, self.lon, self.lat
+        cy0, cy1 = self._cell_y(ymin), self._cell_y(ymax)
+        matches: List[int] = []
+        for cx in range(self._cell_x(xmin), self._cell_x(xmax) + 1):
+            base = cx * self.ny
+            lo = bisect_left(keys, base + cy0)
+            hi = bisect_right(keys, base + cy1, lo)
+            for i in range(lo, hi):
+                r = ranks[i]
+                x = lon[r]
+                y = lat[r]
+                if xmin <= x <= xmax and ymin <= y <= ymax:
+                    matches.append(r)
+        return matches
+
+    def query(
+        self,
+        xmin: float,
+        xmax: float,
+        ymin: float,
+        ymax: float,
+        limit: int = 10000,
+        offset: int = 0,
+        columns: Tuple[str, ...] = DEFAULT_COLUMNS,
+        order: str = "name",
+    ) -> List[Dict[str, Any]]:
+        """Same contract as the SQL bbox query: ORDER BY name, id (or order) LIMIT/OFFSET."""
+        return self.rows(self.query_ranks(xmin, xmax, ymin, ymax, limit=limit, offset=offset, order=order), columns)
+
+    def query_ranks(
+        self,
+        xmin: float,
+        xmax: float,
+        ymin: float,
+        ymax: float,
+        limit: int = 10000,
+        offset: int = 0,
+        order: str = "name",
+    ) -> List[int]:
+        """
+        Like query(), but return the ranks, which identify stops uniquely.
+        order is "name" (name, id), "spatial" (zkey, name, id) or "none" (grid order).
+        """
+        matches = self.search(xmin, xmax, ymin, ymax)
+        offset = max(offset, 0)
+        end = None if limit < 0 else offset + limit
+        if order == "none":
+            return matches[offset:end]
+
+        # Ranks are (name, id) positions; spatial order sorts spatial positions instead
+        if order == "spatial":
+            pos = self.spatial_pos
+            matches = [pos[r] for r in matches]
+        if end is not None and end < len(matches) // 4:
+            page = heapq.nsmallest(end, matches)[offset:]
+        else:
+            page = sorted(matches)[offset:end]
+        if order == "spatial":
+            ranks = self.spatial_ranks
+            return [ranks[p] for p in page]
+        return page
+
+    def rows(self, ranks: Iterable[int], columns: Tuple[str, ...] = DEFAULT_COLUMNS) -> List[Dict[str, Any]]:
+        """Materialize the given ranks as dicts of `columns`."""
+        return [{column: self._value(r, column) for column in columns} for r in ranks]
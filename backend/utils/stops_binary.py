@@ -0,0 +1,121 @@
+"""
+Compact columnar binary encoding for lists of stops.
+
+Served by /api/stops for `?format=bin` or `Accept: application/x-stops-columnar`.
+All integers are little-endian:
+
+    4 bytes   magic "STB1"
+    uint32    stop count (n)
+    uint32    string count (m)
+    int32[n]  lon, microdegrees, delta-encoded from 0
+    int32[n]  lat, microdegrees, delta-encoded from 0
+    uint32[n] name, index into the string table (0xFFFFFFFF = null)
+    uint32[n] bearing, index into the string table (0xFFFFFFFF = null)
+    m times   uvarint byte length + UTF-8 bytes
+
+Names and bearings share one de-duplicated string table.
+"""
+
+import struct
+import sys
+from array import array
+from typing import Any, Dict, List
+
+MEDIA_TYPE = "application/x-stops-columnar"
+MAGIC = b"STB1"
+NULL_INDEX = 0xFFFFFFFF
+
+
+def _uvarint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _le(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode(stops: List[Dict[str, Any]]) -> bytes:
+    """Encode a list of {name, bearing, lon, lat} dicts."""
+    strings: Dict[str, int] = {}
+    lons = array("i")
+    lats = array("i")
+    names = array("I")
+    bearings = array("I")
+    prev_lon = prev_lat = 0
+
+    for stop in stops:
+        lon = int(round(stop["lon"] * 1e6))
+        lat = int(round(stop["lat"] * 1e6))
+        lons.append(lon - prev_lon)
+        lats.append(lat - prev_lat)
+        prev_lon, prev_lat = lon, lat
+        name = stop["name"]
+        names.append(NULL_INDEX if name is None else strings.setdefault(name, len(strings)))
+        bearing = stop["bearing"]
+        bearings.append(NULL_INDEX if bearing is None else strings.setdefault(bearing, len(strings)))
+
+    table = bytearray()
+    for value in strings:
+        raw = value.encode("utf-8")
+        table += _uvarint(len(raw))
+        table += raw
+
+    return b"".join((
+        MAGIC,
+        struct.pack("<II", len(lons), len(strings)),
+        _le(lons), _le(lats), _le(names), _le(bearings),
+        bytes(table),
+    ))
+
+
+def decode(data: bytes) -> List[Dict[str, Any]]:
+    """Inverse of encode(); coordinates come back rounded to microdegrees."""
+    if data[:4] != MAGIC:
+        raise ValueError("not a stops columnar payload")
+    count, string_count = struct.unpack_from("<II", data, 4)
+    pos = 12
+
+    def column(typecode: str) -> array:
+        nonlocal pos
+        values = array(typecode)
+        values.frombytes(data[pos:pos + 4 * count])
+        if sys.byteorder != "little":
+            values.byteswap()
+        pos += 4 * count
+        return values
+
+    lons, lats, names, bearings = column("i"), column("i"), column("I"), column("I")
+
+    strings = []
+    for _ in range(string_count):
+        length = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        strings.append(data[pos:pos + length].decode("utf-8"))
+        pos += length
+
+    stops = []
+    lon = lat = 0
+    for i in range(count):
+        lon += lons[i]
+        lat += lats[i]
+        stops.append({
+            "name": None if names[i] == NULL_INDEX else strings[names[i]],
+            "bearing": None if bearings[i] == NULL_INDEX else strings[bearings[i]],
+            "lon": lon / 1e6,
+            "lat": lat / 1e6,
+        })
+    return stops